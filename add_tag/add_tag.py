@@ -1,4 +1,4 @@
-# add_tag.py V8.1.1
+# add_tag.py V8.2.1
 #
 # Copyright (c) 2021-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
@@ -120,16 +120,38 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
             email_modified = True
 
+    list_subtype = list()
+
     if config.text_tag:
-        # add text body tag
+        list_subtype.append(TYPE_TEXT)
+
+    if config.html_tag:
+        list_subtype.append(TYPE_HTML)
+
+    if config.calendar_tag:
+        list_subtype.append(TYPE_CALENDAR)
+
+    dict_part = dict()
+
+    if list_subtype:
+        # extract first part of each content subtype in single walk
 
         try:
-            part = extract_part(email, TYPE_TEXT)
+            for part in iter_parts(email, list_subtype, nested=True):
+                dict_part.setdefault(part[0].get_content_subtype(), part)
+
+                if len(dict_part) == len(list_subtype):
+                    break
         except Exception as ex:
             write_log(log, ex)
 
             return ReturnCode.DETECTED
 
+    if config.text_tag:
+        # add text body tag
+
+        part = dict_part.get(TYPE_TEXT)
+
         if part is not None:
             (part, charset, content) = part
 
@@ -153,12 +175,7 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     if config.html_tag:
         # add HTML body tag
 
-        try:
-            part = extract_part(email, TYPE_HTML)
-        except Exception as ex:
-            write_log(log, ex)
-
-            return ReturnCode.DETECTED
+        part = dict_part.get(TYPE_HTML)
 
         if part is not None:
             (part, charset, content) = part
@@ -180,12 +197,7 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     if config.calendar_tag:
         # add calendar tag
 
-        try:
-            part = extract_part(email, TYPE_CALENDAR)
-        except Exception as ex:
-            write_log(log, ex)
-
-            return ReturnCode.DETECTED
+        part = dict_part.get(TYPE_CALENDAR)
 
         if part is not None:
             (part, charset, content) = part
@@ -1,17 +1,216 @@
-# check_hash.py V1.0.0
+# check_hash.py V1.2.1
 #
 # Copyright (c) 2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
-from hashlib import md5, sha256
+from pathlib import Path
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5, sha1, sha256
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "md5_hashes", "sha256_hashes" )
+CONFIG_PARAMETERS = ( "md5_hashes", "sha1_hashes", "sha256_hashes", "md5_feed", "sha1_feed", "sha256_feed" )
+
+MAX_WORKERS = 4
+
+DIR_INDEX = Path("/tmp/check_hash")
+
+SOURCE_LEXICAL = "lexical"
+SOURCE_FEED = "feed"
+
+SIZE_MD5 = 16 # in bytes
+SIZE_SHA1 = 20 # in bytes
+SIZE_SHA256 = 32 # in bytes
+
+# hash algorithms in order of checking
+DICT_HASH = { "MD5": md5, "SHA-1": sha1, "SHA-256": sha256 }
+
+MAGIC_INDEX = b"CSHASH01"
+
+# magic, source stamp, digest size, number of Bloom filter hash functions, number of Bloom filter bits, number of digests
+STRUCT_HEADER = Struct("<8s32sIIQQ")
+
+BLOOM_BITS = 10 # per digest
+BLOOM_HASHES = 7 # false positive rate below 1%
+
+TupleIndex = namedtuple("TupleIndex", "buffer digest_size num_hash num_bits offset_digest count")
+
+DICT_INDEX = dict()
+
+def bloom_positions(digest, num_hash, num_bits):
+    """
+    Return Bloom filter bit positions for digest (digests are uniformly distributed, so they are used directly for double hashing).
+
+    :type digest: bytes
+    :type num_hash: int
+    :type num_bits: int
+    :rtype: list
+    """
+    hash_first = int.from_bytes(digest[:8], "little")
+    hash_second = int.from_bytes(digest[8:16], "little") | 1
+
+    return [ (hash_first + index * hash_second) % num_bits for index in range(num_hash) ]
+
+def build_index(list_hash, digest_size, stamp):
+    """
+    Build hash index (header, Bloom filter and sorted fixed-width binary digests) from list of hex hashes (lines not starting with a hash of the given size are skipped).
+
+    :type list_hash: list
+    :type digest_size: int
+    :type stamp: bytes
+    :rtype: bytes
+    """
+    set_digest = set()
+
+    for hash in list_hash:
+        split_hash = hash.split()
+
+        if not split_hash:
+            continue
+
+        try:
+            digest = bytes.fromhex(split_hash[0])
+        except ValueError:
+            continue
+
+        if len(digest) == digest_size:
+            set_digest.add(digest)
+
+    list_digest = sorted(set_digest)
+
+    num_bits = max(len(list_digest) * BLOOM_BITS, 64) + 7 & ~7
+
+    bloom = bytearray(num_bits // 8)
+
+    for digest in list_digest:
+        for position in bloom_positions(digest, BLOOM_HASHES, num_bits):
+            bloom[position >> 3] |= 1 << (position & 7)
+
+    return STRUCT_HEADER.pack(MAGIC_INDEX, stamp, digest_size, BLOOM_HASHES, num_bits, len(list_digest)) + bytes(bloom) + b"".join(list_digest)
+
+def open_index(buffer):
+    """
+    Open hash index stored in buffer.
+
+    :type buffer: bytes or mmap
+    :rtype: TupleIndex
+    """
+    (_, _, digest_size, num_hash, num_bits, count) = STRUCT_HEADER.unpack_from(buffer)
+
+    return TupleIndex(buffer=buffer, digest_size=digest_size, num_hash=num_hash, num_bits=num_bits, offset_digest=STRUCT_HEADER.size + num_bits // 8, count=count)
+
+def get_index(source_type, source, digest_size):
+    """
+    Return hash index for lexical list or feed file. The index file is only rebuilt when the source has changed and is memory mapped otherwise.
+
+    :type source_type: str
+    :type source: str
+    :type digest_size: int
+    :rtype: TupleIndex
+    """
+    if (source_type, source) in DICT_INDEX:
+        return DICT_INDEX[(source_type, source)]
+
+    if source_type == SOURCE_LEXICAL:
+        # lexical lists are stored in CS config
+        path_source = LAST_CONFIG
+    else:
+        path_source = source
+
+    try:
+        stat_source = Path(path_source).stat()
+    except Exception:
+        raise Exception(f"Cannot access '{path_source}'")
+
+    stamp = sha256(f"{source_type}:{source}:{stat_source.st_mtime_ns}:{stat_source.st_size}".encode()).digest()
+
+    path_index = DIR_INDEX.joinpath(f"{sha256(f'{source_type}:{source}:{digest_size}'.encode()).hexdigest()[:32]}.idx")
+
+    index = None
+
+    if cache_trusted(DIR_INDEX) and path_index.is_file():
+        try:
+            with open(path_index, "rb") as f:
+                buffer = mmap(f.fileno(), 0, access=ACCESS_READ)
+
+            (magic, stamp_index, digest_size_index) = STRUCT_HEADER.unpack_from(buffer)[:3]
+
+            if magic == MAGIC_INDEX and stamp_index == stamp and digest_size_index == digest_size:
+                index = open_index(buffer)
+            else:
+                buffer.close()
+        except Exception:
+            pass
+
+    if index is None:
+        if source_type == SOURCE_LEXICAL:
+            list_hash = lexical_list(source)
+        else:
+            list_hash = read_text(source, ignore_errors=True).split("\n")
+
+        buffer = build_index(list_hash, digest_size, stamp)
+
+        write_cache(DIR_INDEX, path_index.name, buffer)
+
+        index = open_index(buffer)
+
+    DICT_INDEX[(source_type, source)] = index
+
+    return index
+
+def index_contains(index, digest):
+    """
+    Check whether digest is contained in hash index (Bloom filter check followed by binary search).
+
+    :type index: TupleIndex
+    :type digest: bytes
+    :rtype: bool
+    """
+    for position in bloom_positions(digest, index.num_hash, index.num_bits):
+        if not index.buffer[STRUCT_HEADER.size + (position >> 3)] & (1 << (position & 7)):
+            return False
+
+    low = 0
+    high = index.count
+
+    while low < high:
+        middle = (low + high) // 2
+
+        offset = index.offset_digest + middle * index.digest_size
+
+        digest_index = index.buffer[offset:offset + index.digest_size]
+
+        if digest_index < digest:
+            low = middle + 1
+        elif digest_index > digest:
+            high = middle
+        else:
+            return True
+
+    return False
+
+def hash_part(part, list_algorithm):
+    """
+    Calculate digests of decoded payload of part for all hash algorithms in a single pass.
+
+    :type part: email.message.EmailMessage
+    :type list_algorithm: list
+    :rtype: dict
+    """
+    dict_hash = { algorithm: DICT_HASH[algorithm]() for algorithm in list_algorithm }
+
+    for chunk in iter_payload(part):
+        for hash in dict_hash.values():
+            hash.update(chunk)
+
+    return { algorithm: hash.digest() for (algorithm, hash) in dict_hash.items() }
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
-    Check MD5 and SHA-256 hashes of attachments against list of known malicious hashes.
+    Check MD5, SHA-1 and SHA-256 hashes of attachments against list of known malicious hashes.
 
     :type input: str
     :type log: str
@@ -21,7 +220,7 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     :type disable_splitting: bool
     :type reformat_header: bool
     """
-    if not (config.md5_hashes or config.sha256_hashes):
+    if not (config.md5_hashes or config.sha1_hashes or config.sha256_hashes or config.md5_feed or config.sha1_feed or config.sha256_feed):
         return ReturnCode.NONE
 
     try:
@@ -31,39 +230,48 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
         return ReturnCode.ERROR
 
-    if config.md5_hashes:
-        try:
-            set_md5 = { hash.lower() for hash in set(lexical_list(config.md5_hashes)) }
-        except Exception as ex:
-            write_log(log, ex)
+    dict_index = dict()
 
-            return ReturnCode.ERROR
-    else:
-        set_md5 = set()
+    for (algorithm, source_type, source, digest_size) in [
+        ( "MD5", SOURCE_LEXICAL, config.md5_hashes, SIZE_MD5 ),
+        ( "MD5", SOURCE_FEED, config.md5_feed, SIZE_MD5 ),
+        ( "SHA-1", SOURCE_LEXICAL, config.sha1_hashes, SIZE_SHA1 ),
+        ( "SHA-1", SOURCE_FEED, config.sha1_feed, SIZE_SHA1 ),
+        ( "SHA-256", SOURCE_LEXICAL, config.sha256_hashes, SIZE_SHA256 ),
+        ( "SHA-256", SOURCE_FEED, config.sha256_feed, SIZE_SHA256 ),
+    ]:
+        if source:
+            try:
+                dict_index.setdefault(algorithm, list()).append(get_index(source_type, source, digest_size))
+            except Exception as ex:
+                write_log(log, ex)
 
-    if config.sha256_hashes:
-        try:
-            set_sha256 = { hash.lower() for hash in set(lexical_list(config.sha256_hashes)) }
-        except Exception as ex:
-            write_log(log, ex)
+                return ReturnCode.ERROR
 
-            return ReturnCode.ERROR
-    else:
-        set_sha256 = set()
+    list_algorithm = [ algorithm for algorithm in DICT_HASH if algorithm in dict_index ]
 
-    for part in email.walk():
-        if part.is_attachment():
-            data = part.get_payload(decode=True)
+    # multipart and message/rfc822 attachments are containers without payload of their own
+    list_part = [ part for part in email.walk() if part.is_attachment() and not part.is_multipart() ]
 
-            if set_md5 and md5(data).hexdigest() in set_md5:
-                found = "MD5"
-            elif set_sha256 and sha256(data).hexdigest() in set_sha256:
-                found = "SHA-256"
-            else:
-                found = None
+    if not list_part:
+        return ReturnCode.NONE
+
+    try:
+        if len(list_part) > 1:
+            # hashlib releases the GIL for large buffers
+            with ThreadPoolExecutor(max_workers=min(len(list_part), MAX_WORKERS)) as executor:
+                list_digest = list(executor.map(hash_part, list_part, [ list_algorithm ] * len(list_part)))
+        else:
+            list_digest = [ hash_part(list_part[0], list_algorithm) ]
+    except Exception as ex:
+        write_log(log, ex)
+
+        return ReturnCode.ERROR
 
-            if found is not None:
-                write_log(log, f"{found} {part.get_filename()}")
+    for (part, dict_digest) in zip(list_part, list_digest):
+        for algorithm in list_algorithm:
+            if any(index_contains(index, dict_digest[algorithm]) for index in dict_index[algorithm]):
+                write_log(log, f"{algorithm} {part.get_filename()}")
 
                 return ReturnCode.DETECTED
 
@@ -1,16 +1,314 @@
-# check_ocr.py V3.1.0
+# check_ocr.py V3.6.3
 #
 # Copyright (c) 2022-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
 from re import compile, search, IGNORECASE
 from io import BytesIO
-from PIL import Image
+from queue import SimpleQueue, Empty
+from math import sqrt
+from collections import namedtuple
+from multiprocessing import get_context
+from functools import partial
+from PIL import Image, ImageOps
 from pytesseract import image_to_string
 
+try:
+    from tesserocr import PyTessBaseAPI
+except ImportError:
+    # tesserocr backend not available
+    PyTessBaseAPI = None
+
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "regex_blacklist", "regex_whitelist", "size_min", "size_max", "skip_unsupported" )
+CONFIG_PARAMETERS = ( "regex_blacklist", "regex_whitelist", "size_min", "size_max", "skip_unsupported", "ocr_backend", "cache_results", "perceptual_hash", "preprocess", "max_pixels", "timeout", "max_frames", "tile_height" )
+
+MAX_WORKERS = 4
+
+TupleMatcher = namedtuple("TupleMatcher", "pattern list_pattern list_separate")
+
+DICT_MATCHER = dict()
+
+NAMESPACE_CACHE = "check_ocr"
+
+LANGUAGE_OCR = "eng+deu"
+
+DPI_OCR = 300
+
+MARGIN_CROP = 10 # in pixel
+
+OVERLAP_TILE = 50 # in pixel
+
+BACKEND_TESSEROCR = "tesserocr"
+BACKEND_PYTESSERACT = "pytesseract"
+
+# initialized tesserocr engines for reuse by frames and tiles processed in same process
+POOL_ENGINE = SimpleQueue()
+
+def preprocess_image(image, max_pixels):
+    """
+    Prepare image for OCR: convert to grayscale, downscale to at most max pixels (and 300 DPI), binarize to dark text on light background and crop to region containing text.
+
+    :type image: PIL.Image.Image
+    :type max_pixels: int
+    :rtype: PIL.Image.Image
+    """
+    scale = 1
+
+    dpi = image.info.get("dpi")
+
+    if dpi and dpi[0] > DPI_OCR:
+        scale = DPI_OCR / dpi[0]
+
+    if max_pixels and image.width * image.height > max_pixels:
+        scale = min(scale, sqrt(max_pixels / (image.width * image.height)))
+
+    image = image.convert("L")
+
+    if scale < 1:
+        image = image.resize((max(round(image.width * scale), 1), max(round(image.height * scale), 1)), Image.Resampling.LANCZOS)
+
+    threshold = otsu_threshold(image.histogram())
+
+    image = image.point([ 0 if value <= threshold else 255 for value in range(256) ])
+
+    histogram = image.histogram()
+
+    # text is assumed to be the minority color
+    if histogram[0] > histogram[255]:
+        image = ImageOps.invert(image)
+
+    box = ImageOps.invert(image).getbbox()
+
+    if box is not None:
+        image = image.crop((max(box[0] - MARGIN_CROP, 0), max(box[1] - MARGIN_CROP, 0), min(box[2] + MARGIN_CROP, image.width), min(box[3] + MARGIN_CROP, image.height)))
+
+    return image
+
+def ocr_tesserocr(image, timeout):
+    """
+    Extract text from image with in-process tesseract engine taken from engine pool.
+
+    :type image: PIL.Image.Image
+    :type timeout: int
+    :rtype: str
+    """
+    try:
+        engine = POOL_ENGINE.get_nowait()
+    except Empty:
+        engine = PyTessBaseAPI(lang=LANGUAGE_OCR)
+
+    try:
+        engine.SetImage(image)
+
+        if not engine.Recognize(timeout * 1000):
+            raise Exception("OCR time limit exceeded")
+
+        return engine.GetUTF8Text()
+    finally:
+        engine.Clear()
+
+        POOL_ENGINE.put(engine)
+
+def ocr_pytesseract(image, timeout):
+    """
+    Extract text from image with tesseract subprocess.
+
+    :type image: PIL.Image.Image
+    :type timeout: int
+    :rtype: str
+    """
+    try:
+        return image_to_string(image, lang=LANGUAGE_OCR, timeout=timeout)
+    except RuntimeError:
+        raise Exception("OCR time limit exceeded")
+
+DICT_BACKEND = { BACKEND_TESSEROCR: ocr_tesserocr, BACKEND_PYTESSERACT: ocr_pytesseract }
+
+def get_backend(backend):
+    """
+    Return OCR function for backend (pytesseract if no backend specified).
+
+    :type backend: str
+    :rtype: function
+    """
+    if not backend:
+        backend = BACKEND_PYTESSERACT
+    elif backend not in DICT_BACKEND:
+        raise Exception(f"Unknown OCR backend '{backend}'")
+    elif backend == BACKEND_TESSEROCR and PyTessBaseAPI is None:
+        raise Exception("OCR backend 'tesserocr' not installed")
+
+    return DICT_BACKEND[backend]
+
+def split_image(image, max_frames, preprocess, max_pixels, tile_height):
+    """
+    Split image into (preprocessed) frames or pages and tiles of overlapping horizontal strips for frames higher than tile height.
+
+    :type image: PIL.Image.Image
+    :type max_frames: int
+    :type preprocess: bool
+    :type max_pixels: int
+    :type tile_height: int
+    :rtype: list
+    """
+    num_frames = getattr(image, "n_frames", 1)
+
+    if max_frames:
+        num_frames = min(num_frames, max_frames)
+
+    list_image = list()
+
+    for index in range(num_frames):
+        image.seek(index)
+
+        frame = image.copy()
+
+        if preprocess:
+            try:
+                frame = preprocess_image(frame, max_pixels)
+            except Exception:
+                # leave unsupported image types to OCR backend
+                pass
+
+        if tile_height and frame.height > tile_height + OVERLAP_TILE:
+            for top in range(0, frame.height - OVERLAP_TILE, tile_height):
+                list_image.append(frame.crop((0, top, frame.width, min(top + tile_height + OVERLAP_TILE, frame.height))))
+        else:
+            list_image.append(frame)
+
+    return list_image
+
+def get_matcher(list_regex):
+    """
+    Return matcher for list of regex, compiled into single alternation (with one named group per regex) for matching all regex in one scan.
+
+    :type list_regex: list
+    :rtype: TupleMatcher
+    """
+    tuple_regex = tuple(sorted(set(list_regex)))
+
+    if tuple_regex in DICT_MATCHER:
+        return DICT_MATCHER[tuple_regex]
+
+    list_pattern = list()
+    list_combined = list()
+    list_separate = list()
+
+    for regex in tuple_regex:
+        pattern = compile(regex, IGNORECASE)
+
+        regex = combinable_regex(regex, f"regex_{len(list_pattern)}")
+
+        if regex is not None:
+            list_combined.append(regex)
+        else:
+            list_separate.append(pattern)
+
+        list_pattern.append(pattern)
+
+    try:
+        pattern = compile("|".join(list_combined), IGNORECASE) if list_combined else None
+    except Exception:
+        pattern = None
+
+        list_separate = list_pattern
+
+    matcher = TupleMatcher(pattern=pattern, list_pattern=list_pattern, list_separate=list_separate)
+
+    DICT_MATCHER[tuple_regex] = matcher
+
+    return matcher
+
+def matcher_search(matcher, text):
+    """
+    Return original pattern of first regex of matcher matching text (None if no regex matches).
+
+    :type matcher: TupleMatcher
+    :type text: str
+    :rtype: re.Pattern or None
+    """
+    if matcher.pattern is not None:
+        match = search(matcher.pattern, text)
+
+        if match is not None:
+            return matcher.list_pattern[int(match.lastgroup.removeprefix("regex_"))]
+
+    for pattern in matcher.list_separate:
+        if search(pattern, text) is not None:
+            return pattern
+
+    return None
+
+def text_blacklisted(text, blacklist, whitelist):
+    """
+    Return blacklisted pattern matching text (None if no pattern matches or text is whitelisted).
+
+    :type text: str
+    :type blacklist: TupleMatcher
+    :type whitelist: TupleMatcher or None
+    :rtype: re.Pattern or None
+    """
+    if text:
+        if whitelist is not None and matcher_search(whitelist, text) is not None:
+            return None
+
+        return matcher_search(blacklist, text)
+
+    return None
+
+def ocr_indexed(ocr, timeout, item):
+    """
+    Extract text from image together with its index.
+
+    :type ocr: function
+    :type timeout: int
+    :type item: tuple
+    :rtype: tuple
+    """
+    (index, image) = item
+
+    return (index, ocr(image, timeout))
+
+def ocr_images(list_image, ocr, timeout, blacklist, whitelist):
+    """
+    Extract text from images (in parallel for multiple images) and return list of extracted texts and blacklisted pattern matching their combined text.
+
+    Without whitelist processing stops as soon as the text of a single image matches a blacklisted pattern. With whitelist all images are processed, as the whitelist applies to the combined text.
+
+    :type list_image: list
+    :type ocr: function
+    :type timeout: int
+    :type blacklist: TupleMatcher
+    :type whitelist: TupleMatcher or None
+    :rtype: tuple
+    """
+    if len(list_image) == 1:
+        text = ocr(list_image[0], timeout)
+
+        return ([ text, ], text_blacklisted(text, blacklist, whitelist))
+
+    list_text = [ "", ] * len(list_image)
+
+    # command module is loaded into __main__, so worker processes must be forked
+    pool = get_context("fork").Pool(processes=min(len(list_image), MAX_WORKERS))
+
+    try:
+        for (index, text) in pool.imap_unordered(partial(ocr_indexed, ocr, timeout), enumerate(list_image)):
+            list_text[index] = text
+
+            if whitelist is None and text:
+                pattern = matcher_search(blacklist, text)
+
+                if pattern is not None:
+                    return (list_text, pattern)
+    finally:
+        # workers still running after match are killed rather than waited for
+        pool.terminate()
+
+        pool.join()
+
+    return (list_text, text_blacklisted("\n".join(list_text), blacklist, whitelist))
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
@@ -26,14 +324,14 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     """
     try:
         with open(input, "rb") as f:
-            image = f.read()
+            data = f.read()
     except Exception:
         write_log(log, f"Cannot read image '{input}'")
 
         return ReturnCode.ERROR
 
     try:
-        image = Image.open(BytesIO(image))
+        image = Image.open(BytesIO(data))
     except Exception:
         if config.skip_unsupported:
             return ReturnCode.NONE
@@ -46,42 +344,66 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
         return ReturnCode.NONE
 
     try:
-        set_blacklist = set(lexical_list(config.regex_blacklist))
+        ocr = get_backend(config.ocr_backend)
+    except Exception as ex:
+        write_log(log, ex)
+
+        return ReturnCode.ERROR
+
+    try:
+        blacklist = get_matcher(lexical_list(config.regex_blacklist))
+
+        if config.regex_whitelist:
+            whitelist = get_matcher(lexical_list(config.regex_whitelist))
+        else:
+            whitelist = None
     except Exception as ex:
         write_log(log, ex)
 
         return ReturnCode.ERROR
 
-    set_blacklist = { compile(regex, IGNORECASE) for regex in set_blacklist }
+    if config.cache_results:
+        # text extracted under different OCR settings is not reused
+        list_key = image_keys(data, image if config.perceptual_hash else None, ( config.ocr_backend, config.preprocess, config.max_pixels, config.max_frames, config.tile_height, LANGUAGE_OCR ))
 
-    if config.regex_whitelist:
-        try:
-            set_whitelist = set(lexical_list(config.regex_whitelist))
-        except Exception as ex:
-            write_log(log, ex)
+        cached = cached_result(NAMESPACE_CACHE, list_key)
 
-            return ReturnCode.ERROR
+        # incomplete text (processing stopped after match) cannot be checked against whitelist
+        if cached is not None and (cached[0]["complete"] or whitelist is None):
+            (cached, exact) = cached
 
-        set_whitelist = { compile(regex, IGNORECASE) for regex in set_whitelist }
+            pattern = text_blacklisted("\n".join(cached["text"]), blacklist, whitelist)
+
+            if pattern is not None:
+                write_log(log, pattern.pattern)
+
+                return ReturnCode.DETECTED
+
+            # text cached by perceptual hash may be from a different image, so it only confirms a match
+            if exact and cached["complete"]:
+                return ReturnCode.NONE
 
     try:
-        text = image_to_string(image, lang="eng+deu")
+        (list_text, pattern) = ocr_images(split_image(image, config.max_frames, config.preprocess, config.max_pixels, config.tile_height), ocr, config.timeout, blacklist, whitelist)
     except TypeError as ex:
-        if not config.skip_unsupported:
-            write_log(log, ex)
-
-            return ReturnCode.ERROR
-    else:
-        if text:
-            if config.regex_whitelist:
-                for pattern in set_whitelist:
-                    if search(pattern, text) is not None:
-                        return ReturnCode.NONE
-
-            for pattern in set_blacklist:
-                if search(pattern, text) is not None:
-                    write_log(log, pattern.pattern)
-
-                    return ReturnCode.DETECTED
+        if config.skip_unsupported:
+            return ReturnCode.NONE
+
+        write_log(log, ex)
+
+        return ReturnCode.ERROR
+    except Exception as ex:
+        write_log(log, ex)
+
+        return ReturnCode.ERROR
+
+    if config.cache_results:
+        # text of images skipped after match is missing, so cached result is only used to confirm match
+        cache_result(NAMESPACE_CACHE, list_key, { "text": list_text, "complete": whitelist is not None or pattern is None })
+
+    if pattern is not None:
+        write_log(log, pattern.pattern)
+
+        return ReturnCode.DETECTED
 
     return ReturnCode.NONE
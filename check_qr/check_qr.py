@@ -1,19 +1,440 @@
-# check_qr.py V6.1.0
+# check_qr.py V6.4.4
 #
 # Copyright (c) 2021-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
 from re import compile, finditer, IGNORECASE
+from io import BytesIO
+from collections import namedtuple
+from zipfile import ZipFile
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 from pyzbar.pyzbar import decode
+from fitz import open as fitz, csGRAY
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "url_blacklist", "url_whitelist" )
+CONFIG_PARAMETERS = ( "url_blacklist", "url_whitelist", "cache_results", "perceptual_hash", "prefilter", "max_pages", "max_images", "render_dpi" )
+
+MAX_WORKERS = 4
+
+CONTAINER_PDF = "pdf"
+CONTAINER_OOXML = "ooxml"
+
+TUPLE_OOXML_MEDIA = ( "word/media/", "xl/media/", "ppt/media/" )
+
+MAX_SIZE_IMAGE = 20971520 # in bytes
+
+NAMESPACE_CACHE = "check_qr"
+
+SIZE_DETECT = 512 # longest side of copy for finder pattern detection in pixel
+
+VARIANCE_FINDER = 0.6 # tolerated deviation of run length in modules
+
+MAX_FINDERS = 30 # more finder pattern candidates indicate noise rather than QR-codes
+
+MODULES_CLUSTER = 60 # maximum distance of finder patterns of same QR-code in modules
+MODULES_MARGIN = 8 # distance of region border from finder pattern center in modules (half finder pattern and quiet zone)
+
+LIST_SCALE = [ 1, 2, 0.5 ]
+
+TupleRun = namedtuple("TupleRun", "start length dark")
+TupleFinder = namedtuple("TupleFinder", "x y module")
+
+def list_runs(line):
+    """
+    Return runs of same color in line of binarized pixels (1 for dark, 0 for light).
+
+    :type line: bytes
+    :rtype: list
+    """
+    list_run = list()
+
+    start = 0
+
+    dark = line[0] if line else 0
+
+    while start < len(line):
+        end = line.find(b"\x00" if dark else b"\x01", start)
+
+        if end < 0:
+            end = len(line)
+
+        list_run.append(TupleRun(start=start, length=end - start, dark=dark))
+
+        start = end
+
+        dark ^= 1
+
+    return list_run
+
+def finder_module(list_run):
+    """
+    Return module size if runs match 1:1:3:1:1 ratio of QR finder pattern (0 if no match).
+
+    :type list_run: list
+    :rtype: float
+    """
+    if not list_run[0].dark:
+        return 0
+
+    module = sum(run.length for run in list_run) / 7
+
+    if module < 1:
+        return 0
+
+    variance = module * VARIANCE_FINDER
+
+    for (run, modules) in zip(list_run, ( 1, 1, 3, 1, 1 )):
+        if abs(run.length - modules * module) >= modules * variance:
+            return 0
+
+    return module
+
+def find_finders(dark, width, height):
+    """
+    Find centers of QR finder pattern candidates matching horizontally and vertically in binarized image (stops after more than MAX_FINDERS candidates).
+
+    :type dark: bytes
+    :type width: int
+    :type height: int
+    :rtype: list
+    """
+    list_finder = list()
+
+    for y in range(height):
+        list_run = list_runs(dark[y * width:(y + 1) * width])
+
+        for index in range(len(list_run) - 4):
+            # center of finder pattern is dark and three modules wide
+            if not list_run[index].dark or list_run[index + 2].length < 3:
+                continue
+
+            module = finder_module(list_run[index:index + 5])
+
+            if not module:
+                continue
+
+            x = list_run[index + 2].start + list_run[index + 2].length // 2
+
+            if any(abs(finder.x - x) < 3 * module and abs(finder.y - y) < 3 * module for finder in list_finder):
+                continue
+
+            list_column = list_runs(dark[x::width])
+
+            for index_column in range(2, len(list_column) - 2):
+                run = list_column[index_column]
+
+                if run.start <= y < run.start + run.length:
+                    module_column = finder_module(list_column[index_column - 2:index_column + 3])
+
+                    if module_column and abs(module_column - module) < module * VARIANCE_FINDER:
+                        list_finder.append(TupleFinder(x=x, y=run.start + run.length // 2, module=(module + module_column) / 2))
+
+                        if len(list_finder) > MAX_FINDERS:
+                            return list_finder
+
+                    break
+
+    return list_finder
+
+def candidate_regions(list_finder):
+    """
+    Group finder patterns into QR-code candidates and return their regions (at least two finder patterns required, with only two the region is extended by their distance as the position of the third is unknown).
+
+    :type list_finder: list
+    :rtype: list
+    """
+    list_cluster = list()
+
+    for finder in list_finder:
+        for cluster in list_cluster:
+            if any(max(abs(finder.x - other.x), abs(finder.y - other.y)) < MODULES_CLUSTER * max(finder.module, other.module) for other in cluster):
+                cluster.append(finder)
+
+                break
+        else:
+            list_cluster.append([ finder, ])
+
+    list_region = list()
+
+    for cluster in list_cluster:
+        if len(cluster) > 1:
+            margin = MODULES_MARGIN * max(finder.module for finder in cluster)
+
+            if len(cluster) == 2:
+                margin += max(abs(cluster[0].x - cluster[1].x), abs(cluster[0].y - cluster[1].y))
+
+            list_region.append((min(finder.x for finder in cluster) - margin, min(finder.y for finder in cluster) - margin, max(finder.x for finder in cluster) + margin, max(finder.y for finder in cluster) + margin))
+
+    return list_region
+
+def decode_qr(image, prefilter):
+    """
+    Decode QR-codes in image. With prefilter, only regions around finder patterns are decoded at a few scales and images without finder patterns are skipped (QR-codes with modules smaller than the longest image side divided by SIZE_DETECT can be missed, as they vanish in the downscaled copy used for detection). Images with too many finder pattern candidates are decoded as a whole.
+
+    :type image: PIL.Image.Image
+    :type prefilter: bool
+    :rtype: list
+    """
+    if not prefilter:
+        return decode(image)
+
+    try:
+        image_gray = image.convert("L")
+    except Exception:
+        return decode(image)
+
+    scale = min(SIZE_DETECT / max(image_gray.width, image_gray.height), 1)
+
+    if scale < 1:
+        image_detect = image_gray.resize((max(round(image_gray.width * scale), 1), max(round(image_gray.height * scale), 1)), Image.Resampling.BOX)
+    else:
+        image_detect = image_gray
+
+    threshold = otsu_threshold(image_detect.histogram())
+
+    list_finder = find_finders(image_detect.point([ 1 if value <= threshold else 0 for value in range(256) ]).tobytes(), image_detect.width, image_detect.height)
+
+    if not list_finder:
+        return list()
+
+    if len(list_finder) > MAX_FINDERS:
+        # too noisy for finder pattern detection
+        return decode(image)
+
+    list_qr = list()
+
+    for (left, top, right, bottom) in candidate_regions(list_finder):
+        region = image_gray.crop((max(int(left / scale), 0), max(int(top / scale), 0), min(int(right / scale) + 1, image_gray.width), min(int(bottom / scale) + 1, image_gray.height)))
+
+        for scale_decode in LIST_SCALE:
+            if scale_decode == 1:
+                list_result = decode(region)
+            else:
+                list_result = decode(region.resize((max(round(region.width * scale_decode), 1), max(round(region.height * scale_decode), 1)), Image.Resampling.LANCZOS))
+
+            if list_result:
+                list_qr.extend(list_result)
+
+                break
+
+    return list_qr
+
+def qr_payloads(image, prefilter):
+    """
+    Return payloads of QR-codes in image (QR-codes with undecodable payload are skipped).
+
+    :type image: PIL.Image.Image
+    :type prefilter: bool
+    :rtype: list
+    """
+    list_payload = list()
+
+    for qr_code in decode_qr(image, prefilter):
+        try:
+            list_payload.append(qr_code.data.decode())
+        except Exception:
+            pass
+
+    return list_payload
+
+def container_type(data):
+    """
+    Return container type of data (None for images).
+
+    :type data: bytes
+    :rtype: str or None
+    """
+    if data[:1024].find(b"%PDF-") >= 0:
+        return CONTAINER_PDF
+
+    if data.startswith(b"PK\x03\x04"):
+        return CONTAINER_OOXML
+
+    return None
+
+def ooxml_images(data, max_images):
+    """
+    Extract embedded images from OOXML document (DOCX, XLSX, PPTX).
+
+    :type data: bytes
+    :type max_images: int
+    :rtype: list
+    """
+    list_image = list()
+
+    with ZipFile(BytesIO(data)) as file_zip:
+        for info in file_zip.infolist():
+            if info.filename.startswith(TUPLE_OOXML_MEDIA) and not info.is_dir() and info.file_size <= MAX_SIZE_IMAGE:
+                list_image.append(file_zip.read(info))
+
+                if len(list_image) >= max_images:
+                    break
+
+    return list_image
+
+def pdf_images(path_pdf, max_pages, max_images):
+    """
+    Extract embedded images from first pages of PDF and return them together with the number of pages checked (images exceeding maximum size or failing to extract are skipped).
+
+    :type path_pdf: str
+    :type max_pages: int
+    :type max_images: int
+    :rtype: tuple
+    """
+    list_image = list()
+
+    with fitz(path_pdf) as pdf_file:
+        num_pages = min(pdf_file.page_count, max_pages)
+
+        set_xref = set()
+
+        for index in range(num_pages):
+            for image in pdf_file[index].get_images(full=True):
+                xref = image[0]
+
+                if xref in set_xref:
+                    continue
+
+                set_xref.add(xref)
+
+                # size of stored image stream checked before extracting
+                (type_length, length) = pdf_file.xref_get_key(xref, "Length")
+
+                if type_length == "int" and int(length) > MAX_SIZE_IMAGE:
+                    continue
+
+                try:
+                    data_image = pdf_file.extract_image(xref)["image"]
+                except Exception:
+                    # broken images are skipped
+                    continue
+
+                if len(data_image) > MAX_SIZE_IMAGE:
+                    continue
+
+                list_image.append(data_image)
+
+                if len(list_image) >= max_images:
+                    return (list_image, num_pages)
+
+    return (list_image, num_pages)
+
+def render_page(path_pdf, index, dpi, prefilter):
+    """
+    Render PDF page in grayscale and return payloads of QR-codes in it.
+
+    :type path_pdf: str
+    :type index: int
+    :type dpi: int
+    :type prefilter: bool
+    :rtype: list
+    """
+    with fitz(path_pdf) as pdf_file:
+        pixmap = pdf_file[index].get_pixmap(dpi=dpi, colorspace=csGRAY, alpha=False)
+
+    return qr_payloads(Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples), prefilter)
+
+def container_payloads(path_file, data, container, config):
+    """
+    Return payloads of QR-codes in images embedded in PDF or OOXML document (PDF pages are rendered if they contain no images).
+
+    :type path_file: str
+    :type data: bytes
+    :type container: str
+    :type config: TupleConfig
+    :rtype: list
+    """
+    if container == CONTAINER_PDF:
+        (list_data, num_pages) = pdf_images(path_file, config.max_pages, config.max_images)
+    else:
+        list_data = ooxml_images(data, config.max_images)
+
+    list_payload = list()
+
+    for data_image in list_data:
+        try:
+            image = Image.open(BytesIO(data_image))
+
+            image.load()
+        except Exception:
+            # skip unsupported image formats (e.g. EMF/WMF)
+            continue
+
+        list_payload.extend(qr_payloads(image, config.prefilter))
+
+    if container == CONTAINER_PDF and not list_data and num_pages:
+        if num_pages == 1:
+            list_payload.extend(render_page(path_file, 0, config.render_dpi, config.prefilter))
+        else:
+            # PyMuPDF is not thread-safe and command module is loaded into __main__, so pages are rendered in forked processes
+            with ProcessPoolExecutor(max_workers=min(num_pages, MAX_WORKERS), mp_context=get_context("fork")) as executor:
+                for list_result in executor.map(render_page, [ path_file ] * num_pages, range(num_pages), [ config.render_dpi ] * num_pages, [ config.prefilter ] * num_pages):
+                    list_payload.extend(list_result)
+
+    return list_payload
+
+def check_payloads(list_payload, log, config):
+    """
+    Check URLs in QR-code payloads against URL blacklist and corresponding domains against reputation blacklists.
+
+    :type list_payload: list
+    :type log: str
+    :type config: TupleConfig
+    :rtype: ReturnCode
+    """
+    set_url = { match.group(1) for payload in list_payload for match in finditer(PATTERN_URL, payload) }
+
+    if not set_url:
+        return ReturnCode.NONE
+
+    if config.url_blacklist:
+        try:
+            set_blacklist = set(url_list(config.url_blacklist))
+        except Exception as ex:
+            write_log(log, ex)
+
+            return ReturnCode.ERROR
+
+        set_blacklist = { compile(url2regex(url), IGNORECASE) for url in set_blacklist }
+    else:
+        set_blacklist = None
+
+    if config.url_whitelist:
+        try:
+            set_whitelist = set(url_list(config.url_whitelist))
+        except Exception as ex:
+            write_log(log, ex)
+
+            return ReturnCode.ERROR
+
+        set_whitelist = { compile(url2regex(url), IGNORECASE) for url in set_whitelist }
+    else:
+        set_whitelist = None
+
+    set_clean = set()
+
+    for url in set_url:
+        if url not in set_clean:
+            result = url_blacklisted(url, set_whitelist, set_blacklist)
+
+            if result is not None:
+                if result:
+                    write_log(log, f"'{result[0]}' listed on '{result[1]}'")
+
+                write_log(log, f"'{url}' listed on '{config.url_blacklist}'")
+
+                return ReturnCode.DETECTED
+
+            set_clean.add(url)
+
+    return ReturnCode.NONE
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
-    Check URLs from QR-codes in pictures against URL blacklist and corresponding domains against reputation blacklists.
+    Check URLs from QR-codes in pictures, PDF and OOXML documents against URL blacklist and corresponding domains against reputation blacklists.
 
     :type input: str
     :type log: str
@@ -24,62 +445,51 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     :type reformat_header: bool
     """
     try:
-        image = Image.open(input)
+        with open(input, "rb") as f:
+            data = f.read()
     except Exception:
-        write_log(log, f"Cannot read image '{input}'")
+        write_log(log, f"Cannot read file '{input}'")
 
         return ReturnCode.ERROR
 
-    list_qr = decode(image)
-
-    if list_qr:
-        set_url = set()
-
-        for qr_code in list_qr:
-            try:
-                set_url |= set(finditer(PATTERN_URL, qr_code.data.decode()))
-            except Exception:
-                pass
-
-        if set_url:
-            if config.url_blacklist:
-                try:
-                    set_blacklist = set(url_list(config.url_blacklist))
-                except Exception as ex:
-                    write_log(log, ex)
-
-                    return ReturnCode.ERROR
+    container = container_type(data)
 
-                set_blacklist = { compile(url2regex(url), IGNORECASE) for url in set_blacklist }
-            else:
-                set_blacklist = None
+    if container is None:
+        try:
+            image = Image.open(BytesIO(data))
+        except Exception:
+            write_log(log, f"Cannot read image '{input}'")
 
-            if config.url_whitelist:
-                try:
-                    set_whitelist = set(url_list(config.url_whitelist))
-                except Exception as ex:
-                    write_log(log, ex)
+            return ReturnCode.ERROR
+    else:
+        image = None
 
-                    return ReturnCode.ERROR
+    if config.cache_results:
+        # QR-codes decoded under different settings are not reused
+        list_key = image_keys(data, image if config.perceptual_hash else None, ( config.prefilter, config.max_pages, config.max_images, config.render_dpi ))
 
-                set_whitelist = { compile(url2regex(url), IGNORECASE) for url in set_whitelist }
-            else:
-                set_whitelist = None
+        cached = cached_result(NAMESPACE_CACHE, list_key)
 
-            set_clean = set()
+        if cached is not None:
+            (list_payload, exact) = cached
 
-            for url in set_url:
-                if url not in set_clean:
-                    result = url_blacklisted(url, set_whitelist, set_blacklist)
+            result = check_payloads(list_payload, log, config)
 
-                    if result is not None:
-                        if result:
-                            write_log(log, f"'{result[0]}' listed on '{result[1]}'")
+            # QR-codes cached by perceptual hash may be from a different image, so they only confirm a detection
+            if exact or result != ReturnCode.NONE:
+                return result
 
-                        write_log(log, f"'{url}' listed on '{config.url_blacklist}'")
+    if container is None:
+        list_payload = qr_payloads(image, config.prefilter)
+    else:
+        try:
+            list_payload = container_payloads(input, data, container, config)
+        except Exception:
+            write_log(log, f"Cannot extract images from {container.upper()} file '{input}'")
 
-                        return ReturnCode.DETECTED
+            return ReturnCode.ERROR
 
-                    set_clean.add(url)
+    if config.cache_results:
+        cache_result(NAMESPACE_CACHE, list_key, list_payload)
 
-    return ReturnCode.NONE
+    return check_payloads(list_payload, log, config)
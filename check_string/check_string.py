@@ -1,8 +1,11 @@
-# check_string.py V6.0.0
+# check_string.py V6.1.2
 #
 # Copyright (c) 2020-2022 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
+from re import compile, escape
+from mmap import mmap, ACCESS_READ
+
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
 CONFIG_PARAMETERS = ( "search_strings", )
@@ -20,19 +23,48 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     :type reformat_header: bool
     """
     try:
-        email = read_email(input, disable_splitting)
+        with open(input, "rb") as f:
+            try:
+                data = mmap(f.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                # empty file cannot be memory mapped
+                data = None
     except Exception as ex:
         write_log(log, ex)
 
         return ReturnCode.ERROR
 
-    email = email.as_bytes()
+    set_combination = { frozenset(filter(None, list_combination)) for list_combination in config.search_strings }
+
+    # longest strings first so that the longest string starting at a position is matched
+    list_string = sorted(set().union(*set_combination), key=len, reverse=True)
+
+    # only one string is matched per position, strings contained in it are found along with it
+    dict_contained = { string.encode(): { contained for contained in list_string if contained in string } for string in list_string }
+
+    set_found = set()
+
+    try:
+        if data is not None and list_string:
+            # single pass over the data for all strings (lookahead also finds overlapping strings)
+            pattern_string = compile(b"(?=(" + b"|".join(escape(string.encode()) for string in list_string) + b"))")
+
+            for match in pattern_string.finditer(data):
+                set_contained = dict_contained[match.group(1)]
+
+                if set_contained <= set_found:
+                    continue
+
+                set_found.update(set_contained)
+
+                if any(combination <= set_found for combination in set_combination):
+                    return ReturnCode.DETECTED
+    finally:
+        if data is not None:
+            data.close()
 
-    for list_string in config.search_strings:
-        for string in list_string:
-            if email.find(string.encode()) == -1:
-                break
-        else:
-            return ReturnCode.DETECTED
+    # combinations consisting of empty strings only always match
+    if any(not combination for combination in set_combination):
+        return ReturnCode.DETECTED
 
     return ReturnCode.NONE
@@ -1,13 +1,185 @@
-# check_yara.py V1.1.0
+# check_yara.py V1.3.2
 #
 # Copyright (c) 2023-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
-from yara import compile
+from re import compile, MULTILINE
+from os import getuid
+from stat import S_ISREG
+from pathlib import Path
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+from hashlib import sha256
+from yara import compile as yara_compile, load as yara_load, TimeoutError as YaraTimeoutError
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "yara_rules", )
+CONFIG_PARAMETERS = ( "yara_rules", "timeout", "scan_attachments" )
+
+DIR_CACHE = Path("/tmp/check_yara")
+
+DICT_RULES = dict()
+
+SET_ENCODING = { "base64", "quoted-printable" }
+
+PATTERN_INCLUDE = compile(r'^[ \t]*include[ \t]+"([^"\n]+)"', MULTILINE)
+
+def include_stamps(source, path_base, set_included):
+    """
+    Return path, modification time and size of all files included by YARA rule source (recursively, relative includes are resolved against base directory).
+
+    :type source: str
+    :type path_base: Path
+    :type set_included: set
+    :rtype: list
+    """
+    list_stamp = list()
+
+    for match in PATTERN_INCLUDE.finditer(source):
+        path_include = path_base.joinpath(match.group(1)).resolve()
+
+        if path_include in set_included:
+            continue
+
+        set_included.add(path_include)
+
+        try:
+            stat_include = path_include.stat()
+
+            source_include = path_include.read_text(errors="replace")
+        except Exception:
+            # missing include is reported by compiler
+            list_stamp.append(f"{path_include}:missing")
+
+            continue
+
+        list_stamp.append(f"{path_include}:{stat_include.st_mtime_ns}:{stat_include.st_size}")
+
+        list_stamp.extend(include_stamps(source_include, path_include.parent, set_included))
+
+    return list_stamp
+
+def cache_rules(rules, path_cache, hash_source):
+    """
+    Save compiled YARA rules to cache file (preceded by hash of rule source) and remove outdated cache files.
+
+    :type rules: Rules
+    :type path_cache: Path
+    :type hash_source: str
+    """
+    buffer = BytesIO()
+
+    buffer.write(hash_source.encode() + b"\n")
+
+    rules.save(file=buffer)
+
+    if write_cache(DIR_CACHE, path_cache.name, buffer.getvalue()):
+        for path_file in DIR_CACHE.glob("*.yarc"):
+            if path_file != path_cache:
+                path_file.unlink(missing_ok=True)
+
+def load_rules(path_cache, hash_source):
+    """
+    Load compiled YARA rules from cache file, which is only trusted if it is a regular file owned by current user and was written for the same rule source (None if not cached).
+
+    :type path_cache: Path
+    :type hash_source: str
+    :rtype: Rules or None
+    """
+    if not cache_trusted(DIR_CACHE):
+        return None
+
+    try:
+        stat_cache = path_cache.lstat()
+    except Exception:
+        return None
+
+    if not S_ISREG(stat_cache.st_mode) or stat_cache.st_uid != getuid() or stat_cache.st_mode & 0o022:
+        return None
+
+    try:
+        with open(path_cache, "rb") as f:
+            if f.readline() != hash_source.encode() + b"\n":
+                return None
+
+            return yara_load(file=f)
+    except Exception:
+        # cache file corrupt or from different YARA version
+        return None
+
+def get_rules(source):
+    """
+    Return compiled YARA rules for rule source, kept in memory and in cache file keyed by hash of the source and of modification time and size of included files.
+
+    :type source: str
+    :rtype: Rules
+    """
+    list_stamp = include_stamps(source, Path.cwd(), set())
+
+    hash_source = sha256("\n".join([ source, ] + list_stamp).encode()).hexdigest()
+
+    if hash_source in DICT_RULES:
+        return DICT_RULES[hash_source]
+
+    path_cache = DIR_CACHE.joinpath(f"{hash_source}.yarc")
+
+    rules = load_rules(path_cache, hash_source)
+
+    if rules is None:
+        rules = yara_compile(source=source)
+
+        try:
+            cache_rules(rules, path_cache, hash_source)
+        except Exception:
+            pass
+
+    DICT_RULES[hash_source] = rules
+
+    return rules
+
+def scan_parts(email, rules, scan_timeout):
+    """
+    Scan decoded content of all base64 or quoted-printable encoded parts (one at a time) and return name of first matching part and matches or None if no match.
+
+    Parts are decoded in chunks to a temp file scanned by file path, so decoded content is never held in memory.
+
+    :type email: EmailMessage
+    :type rules: Rules
+    :type scan_timeout: int
+    :rtype: tuple or None
+    """
+    with NamedTemporaryFile(dir=DIR_EXTRACT) as f:
+        for part in email.walk():
+            if part.is_multipart() or part.get("Content-Transfer-Encoding", "").strip().lower() not in SET_ENCODING:
+                continue
+
+            name_part = part.get_filename() or part.get_content_type()
+
+            f.seek(0)
+            f.truncate()
+
+            try:
+                for chunk in iter_payload(part):
+                    f.write(chunk)
+            except Exception:
+                raise Exception(f"Cannot decode part '{name_part}'")
+
+            if not f.tell():
+                continue
+
+            f.flush()
+
+            try:
+                matches = rules.match(filepath=f.name, timeout=scan_timeout)
+            except YaraTimeoutError:
+                raise Exception(f"Timeout scanning part '{name_part}'")
+            except Exception:
+                raise Exception(f"Error scanning part '{name_part}'")
+
+            if matches:
+                return ( name_part, matches )
+
+    return None
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
@@ -21,13 +193,6 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     :type disable_splitting: bool
     :type reformat_header: bool
     """
-    try:
-        data = read_binary(input)
-    except Exception as ex:
-        write_log(log, ex)
-
-        return ReturnCode.ERROR
-
     try:
         list_rules = lexical_list(config.yara_rules)
     except Exception as ex:
@@ -36,14 +201,19 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
         return ReturnCode.ERROR
 
     try:
-        rules = compile(source="\n".join(sorted(set(list_rules))))
+        rules = get_rules("\n".join(sorted(set(list_rules))))
     except Exception:
         write_log(log, "Invalid YARA rules")
 
         return ReturnCode.ERROR
 
+    # scanning by file path lets YARA map the file instead of reading it into memory
     try:
-        matches = rules.match(data=data)
+        matches = rules.match(filepath=input, timeout=config.timeout)
+    except YaraTimeoutError:
+        write_log(log, "Timeout scanning data")
+
+        return ReturnCode.ERROR
     except Exception:
         write_log(log, "Error scanning data")
 
@@ -54,4 +224,24 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
         return ReturnCode.DETECTED
 
+    if config.scan_attachments:
+        try:
+            email = read_email(input, disable_splitting)
+        except Exception as ex:
+            write_log(log, ex)
+
+            return ReturnCode.ERROR
+
+        try:
+            result = scan_parts(email, rules, config.timeout)
+        except Exception as ex:
+            write_log(log, ex)
+
+            return ReturnCode.ERROR
+
+        if result is not None:
+            write_log(log, f"{result[0]}: {str(result[1])[1:-1]}")
+
+            return ReturnCode.DETECTED
+
     return ReturnCode.NONE
@@ -1,19 +1,15 @@
-# clean_mail.py V2.1.1
+# clean_mail.py V2.2.0
 #
 # Copyright (c) 2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
-from sys import setrecursionlimit
-from re import compile, search, escape, finditer, sub
+from re import compile, search, escape, sub
 from email.message import EmailMessage
-from bs4 import BeautifulSoup
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
 CONFIG_PARAMETERS = ( "regex_list", "annotation_list", "clean_attachment" )
 
-RECURSION_LIMIT = 5000
-
 PATTERN_ID = compile(r"^<\S+[^>]*[ \t\n]+id=\"(\S+)\"[ \t\n>]")
 
 def clean_mail(email, list_pattern, list_annotation):
@@ -74,43 +70,36 @@ def clean_mail(email, list_pattern, list_annotation):
     if part is not None:
         (part, charset, content) = part
 
-        body_modified = False
-
-        soup = BeautifulSoup(content, features="html5lib")
+        list_token = list(tokenize_html(content))
 
-        for annotation in list_annotation:
-            match = search(PATTERN_ID, annotation.html.strip())
+        list_edit = list()
 
-            if match is not None:
-                list_tag = soup.find_all("div", id=compile(fr".*{escape(match.group(1))}.*"))
+        if list_annotation is not None:
+            for annotation in list_annotation:
+                match = search(PATTERN_ID, annotation.html.strip())
 
-                if list_tag:
-                    for tag in list_tag:
-                        tag.decompose()
+                if match is not None:
+                    id_annotation = match.group(1)
 
-                    body_modified = True
+                    for (index, token) in enumerate(list_token):
+                        if token.type == HTML_START and token.name == "div" and "id" in token.attributes and id_annotation in token.attributes["id"].value:
+                            list_edit.append(edit_element(list_token, index))
 
         if list_pattern is not None:
-            for pattern in list_pattern:
-                for string in soup.findAll(text=pattern):
-                    text = string.text
-
-                    index_shift = 0
-
-                    for match in finditer(pattern, text):
-                        text = text[:match.start() + index_shift] + text[match.end() + index_shift:]
+            for token in list_token:
+                if token.type == HTML_TEXT and token.name is None:
+                    text = html_unescape(content[token.start:token.end])
 
-                        index_shift -= match.end() - match.start()
+                    text_cleaned = text
 
-                    body_modified = True
+                    for pattern in list_pattern:
+                        text_cleaned = sub(pattern, "", text_cleaned)
 
-                    string.replace_with(text)
+                    if text_cleaned != text:
+                        list_edit.append(edit_text(token, text_cleaned))
 
-        if body_modified:
-            try:
-                content = soup.encode(charset).decode(charset)
-            except Exception:
-                raise Exception("Error converting soup to string")
+        if list_edit:
+            content = apply_edits(content, list_edit)
 
             if HEADER_CTE in part:
                 del part[HEADER_CTE]
@@ -143,8 +132,6 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
         return ReturnCode.DETECTED
 
-    setrecursionlimit(RECURSION_LIMIT)
-
     if config.regex_list:
         try:
             list_pattern = [ compile(regex) for regex in lexical_list(config.regex_list) ]
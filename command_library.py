@@ -1,4 +1,4 @@
-# command_library.py V12.0.1
+# command_library.py V12.7.7
 #
 # Copyright (c) 2020-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
@@ -8,20 +8,32 @@ Collection of functions for Clearswift external commands.
 """
 
 from sys import maxsize
-from collections import namedtuple
+from os import getuid
+from stat import S_ISDIR, S_ISREG
+from time import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from hashlib import sha256
+from json import dumps as json_dumps, loads as json_loads
+from collections import namedtuple, Counter
+from itertools import islice
 from email import message_from_binary_file, errors
 from email.policy import EmailPolicy
+from email.contentmanager import ContentManager, raw_data_manager
 from email.headerregistry import HeaderRegistry, BaseHeader, MessageIDHeader
 from email._header_value_parser import _steal_trailing_WSP_if_exists, _fold_as_ew, quote_string, get_dot_atom_text, get_word, get_cfws, get_no_fold_literal, get_domain, get_unstructured, TokenList, Terminal, HeaderLabel, ValueTerminal, CFWSList, WhiteSpaceTerminal, MessageID, MsgID, ObsLocalPart, InvalidMessageID, CFWS_LEADER, PHRASE_ENDS, DOT, SPECIALS, WSP
 from email.utils import _has_surrogates
 from xml.sax import make_parser, handler
 from io import BytesIO
+from threading import Lock
+from weakref import WeakKeyDictionary
 from re import compile, search, escape, sub, IGNORECASE
 from subprocess import run, PIPE, DEVNULL
 from socket import socket, AF_INET, SOCK_STREAM
 from urllib.parse import quote, unquote
-from pyzipper import AESZipFile, ZIP_LZMA
-from lxml.html.html5parser import etree
+from binascii import a2b_base64, a2b_qp
+from html import escape as html_escape, unescape as html_unescape
+from pyzipper import AESZipFile, ZIP_LZMA, WZ_AES
 from dns.resolver import resolve
 from bs4 import UnicodeDammit
 
@@ -34,6 +46,8 @@ BUFFER_TCP = 4096 # in bytes
 PATTERN_URL = compile(r"((?:https?://|www\.|ftp\.)[A-Za-z0-9._-]+[A-Za-z0-9](?:/[A-Za-z0-9._~:/?#[\]@!$&'()*+,;%=-]*[A-Za-z0-9_~/#[\]@$&()*+%=-])?)", IGNORECASE)
 PATTERN_PROTOCOL = compile(r"^(https?://)(\S+)$", IGNORECASE)
 PATTERN_DOMAIN = compile(r"^(?:https?://)?([^/]+)", IGNORECASE)
+PATTERN_GROUP_REFERENCE = compile(r"\\[1-9]|\(\?P=|\(\?\(") # backreferences and conditional group references
+PATTERN_GLOBAL_FLAGS = compile(r"^\(\?([aiLmsux]+)\)")
 
 TupleReputation = namedtuple("TupleReputation", "query_domain record_type match")
 
@@ -72,6 +86,56 @@ TYPE_TEXT = "plain"
 TYPE_HTML = "html"
 TYPE_CALENDAR = "calendar"
 
+HTML_TEXT = "text"
+HTML_START = "start"
+HTML_END = "end"
+HTML_COMMENT = "comment"
+HTML_DECLARATION = "declaration"
+
+HTML_VOID = { "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr" }
+HTML_RAWTEXT = { "script", "style", "textarea", "title", "xmp", "iframe", "noembed", "noframes" }
+HTML_RCDATA = { "textarea", "title" } # raw text elements with character references
+
+PATTERN_HTML_MARKUP = compile(r"<(?:(!--)|([!?])|(/?)([A-Za-z][^\t\n\f\r />]*))")
+PATTERN_HTML_ATTRIBUTE = compile(r"[\t\n\f\r /]*([^\t\n\f\r />][^\t\n\f\r /=>]*)(?:[\t\n\f\r ]*=[\t\n\f\r ]*(\"[^\"]*\"?|'[^']*'?|[^\t\n\f\r >]*))?")
+PATTERN_HTML_CLOSE = compile(r"[\t\n\f\r /]*>") # stray slashes are treated as whitespace
+
+DICT_PATTERN_RAWTEXT = { name: compile(fr"</{name}[\t\n\f\r />]", IGNORECASE) for name in HTML_RAWTEXT }
+
+TupleToken = namedtuple("TupleToken", "type start end name attributes")
+TupleAttribute = namedtuple("TupleAttribute", "value start end")
+TupleEdit = namedtuple("TupleEdit", "start end replacement")
+
+DIR_IMAGE_CACHE = Path("/tmp/image_cache")
+
+MAX_IMAGE_CACHE = 10000 # maximum number of cached results per namespace
+
+AGE_IMAGE_CACHE = 604800 # maximum age of cached results in seconds
+
+INTERVAL_PRUNE = 3600 # minimum interval between pruning image cache in seconds
+
+FILE_PRUNED = ".pruned"
+
+SIZE_DHASH = 8 # hash is SIZE_DHASH * SIZE_DHASH bits
+
+# extract to tmpfs if available
+DIR_EXTRACT = "/dev/shm" if Path("/dev/shm").is_dir() else "/tmp"
+
+SIZE_PAYLOAD_CHUNK = 65536 # in characters
+
+SIZE_SPOOL = 10485760 # maximum size of encrypted ZIP archive kept in memory in bytes
+
+# all bytes outside the base64 alphabet (including padding)
+DELETE_BASE64 = bytes(set(range(256)) - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"))
+
+DECODE_DECLARED = "declared"
+DECODE_DETECTED = "detected"
+
+TupleDecoded = namedtuple("TupleDecoded", "payload declared charset content path")
+
+# decoded text parts by part (entries vanish with the parts)
+DICT_DECODED = WeakKeyDictionary()
+
 class HandlerValue(HandlerBase):
     """
     Custom content handler for lists stored in tag values.
@@ -188,6 +252,17 @@ class Header(TokenList):
         else:
             encoding = "us-ascii"
 
+        # fast path for headers fitting on single line without encoding (folding would leave them unchanged)
+        header = str(self)
+
+        if len(header) <= maxlen:
+            try:
+                header.encode(encoding)
+
+                return header + policy.linesep
+            except UnicodeEncodeError:
+                pass
+
         lines = [""]
 
         leading_whitespace = ""
@@ -394,15 +469,23 @@ def fold_mime_parameters(part, lines, maxlen, encoding, disable_splitting):
 
             splitpoint = maxchars = maxlen - chrome_len - 2
 
-            while True:
-                partial = value[:splitpoint]
+            encoded_value = quote(value[:splitpoint], safe="", errors=error_handler)
 
-                encoded_value = quote(partial, safe="", errors=error_handler)
+            if len(encoded_value) > maxchars:
+                # binary search for longest prefix fitting after encoding (encoded length grows monotonically with prefix length)
+                splitpoint_fit = 0
 
-                if len(encoded_value) <= maxchars:
-                    break
+                while splitpoint - splitpoint_fit > 1:
+                    splitpoint_middle = (splitpoint_fit + splitpoint) // 2
 
-                splitpoint -= 1
+                    if len(quote(value[:splitpoint_middle], safe="", errors=error_handler)) <= maxchars:
+                        splitpoint_fit = splitpoint_middle
+                    else:
+                        splitpoint = splitpoint_middle
+
+                splitpoint = splitpoint_fit
+
+                encoded_value = quote(value[:splitpoint], safe="", errors=error_handler)
 
             lines.append(" {}*{}*={}{}".format(name, section, extra_chrome, encoded_value))
 
@@ -581,6 +664,14 @@ def parse_message_id(value):
 class MessageIDHeaderCustom(MessageIDHeader):
     value_parser = staticmethod(parse_message_id)
 
+HEADER_FACTORY = HeaderRegistry(base_class=BaseHeaderCustom)
+
+CONTENT_MANAGER = ContentManager()
+
+DICT_POLICY = dict()
+
+LOCK_POLICY = Lock()
+
 def get_list(list_type, regex_list, regex_item, last_config=LAST_CONFIG):
     """
     Extract address lists from CS config filtered by regex matches on list name and item.
@@ -754,6 +845,38 @@ def get_text_content(part, errors="replace"):
 
     return content.decode(charset, errors=errors)
 
+def get_policy(disable_splitting):
+    """
+    Return email policy for given disable_splitting value.
+
+    Policies are built once per process and cached. Policies are immutable and the shared header registry and content manager are only modified while building under a lock, so the returned policy can be used from multiple threads.
+
+    :type disable_splitting: bool
+    :rtype: EmailPolicyCustom
+    """
+    disable_splitting = bool(disable_splitting)
+
+    email_policy = DICT_POLICY.get(disable_splitting)
+
+    if email_policy is None:
+        with LOCK_POLICY:
+            email_policy = DICT_POLICY.get(disable_splitting)
+
+            if email_policy is None:
+                if not DICT_POLICY:
+                    HEADER_FACTORY.map_to_type("message-id", MessageIDHeaderCustom)
+
+                    # copy of default content manager, registering handler on default would modify it globally
+                    CONTENT_MANAGER.get_handlers.update(raw_data_manager.get_handlers)
+                    CONTENT_MANAGER.set_handlers.update(raw_data_manager.set_handlers)
+                    CONTENT_MANAGER.add_get_handler("text", get_text_content)
+
+                email_policy = EmailPolicyCustom().clone(linesep="\r\n", header_factory=HEADER_FACTORY, content_manager=CONTENT_MANAGER, disable_splitting=disable_splitting)
+
+                DICT_POLICY[disable_splitting] = email_policy
+
+    return email_policy
+
 def read_email(path_email, disable_splitting):
     """
     Parse email file.
@@ -762,11 +885,7 @@ def read_email(path_email, disable_splitting):
     :type disable_splitting: bool
     :rtype: EmailMessage
     """
-    header_factory = HeaderRegistry(base_class=BaseHeaderCustom)
-    header_factory.map_to_type("message-id", MessageIDHeaderCustom)
-
-    email_policy = EmailPolicyCustom().clone(linesep="\r\n", header_factory=header_factory, disable_splitting=disable_splitting)
-    email_policy.content_manager.add_get_handler("text", get_text_content)
+    email_policy = get_policy(disable_splitting)
 
     try:
         with open(path_email, "rb") as f:
@@ -814,23 +933,35 @@ def write_email(email, path_email, reformat_header):
     except Exception:
         raise Exception(f"Cannot write email to '{path_email}'")
 
-def zip_encrypt(set_data, password):
+def zip_encrypt(set_data, password, compression=ZIP_LZMA):
     """
-    Create encrypted zip archive from set of data with defined password and return as bytes.
+    Create encrypted zip archive from set of data (bytes or function streaming data into file object) with defined password and return as spooled temp file.
 
     :type set_data: set
     :type password: str
-    :rtype: bytes
+    :type compression: int
+    :rtype: SpooledTemporaryFile
     """
-    buffer = BytesIO()
+    f_archive = SpooledTemporaryFile(max_size=SIZE_SPOOL)
+
+    try:
+        with AESZipFile(f_archive, "w", compression=compression, encryption=WZ_AES) as zf:
+            zf.setpassword(password.encode())
+
+            for (file_name, data) in set_data:
+                if callable(data):
+                    with zf.open(file_name, "w") as f_target:
+                        data(f_target)
+                else:
+                    zf.writestr(file_name, data)
+    except Exception:
+        f_archive.close()
 
-    with AESZipFile(buffer, "w", compression=ZIP_LZMA, encryption=pyzipper.WZ_AES) as zf:
-        zf.pwd = password
+        raise
 
-        for (file_name, data) in set_data:
-            zf.writestr(file_name, data)
+    f_archive.seek(0)
 
-    return buffer.getvalue()
+    return f_archive
 
 def unzip_decrypt(bytes_zip, password):
     """
@@ -840,8 +971,8 @@ def unzip_decrypt(bytes_zip, password):
     :type password: str
     :rtype: set
     """
-    with AESZipFile(BytesIO(bytes_zip), "r", compression=ZIP_LZMA, encryption=pyzipper.WZ_AES) as zf:
-        zf.pwd = password
+    with AESZipFile(BytesIO(bytes_zip), "r", compression=ZIP_LZMA, encryption=WZ_AES) as zf:
+        zf.setpassword(password.encode())
 
         set_data = set()
 
@@ -876,14 +1007,255 @@ def extract_text(html):
     """
     list_text = list()
 
-    for line in etree.fromstring(html.encode(), parser=etree.HTMLParser(encoding=CHARSET_UTF8)).xpath("//text()"):
-        line = line.strip()
+    for token in tokenize_html(html):
+        if token.type == HTML_TEXT:
+            line = html[token.start:token.end]
 
-        if line:
-            list_text.append(line)
+            if token.name is None or token.name in HTML_RCDATA:
+                line = html_unescape(line)
+
+            line = line.strip()
+
+            if line:
+                list_text.append(line)
 
     return "\n".join(list_text)
 
+def tokenize_html(html):
+    """
+    Walk HTML once and yield text, tag, comment and declaration tokens with offsets into the original string.
+
+    Tokens are contiguous and cover the whole string. Start tags carry a dict of attributes (lower case name mapped to unescaped value and offsets of the raw value including quotes, first occurrence wins), text tokens inside raw text elements (script, style etc.) carry the name of the enclosing element.
+
+    :type html: str
+    :rtype: generator
+    """
+    length = len(html)
+
+    index = 0
+
+    while index < length:
+        match = PATTERN_HTML_MARKUP.search(html, index)
+
+        if match is None:
+            yield TupleToken(type=HTML_TEXT, start=index, end=length, name=None, attributes=None)
+
+            break
+
+        start = match.start()
+
+        if start > index:
+            yield TupleToken(type=HTML_TEXT, start=index, end=start, name=None, attributes=None)
+
+        if match.group(1):
+            end = html.find("-->", match.end())
+
+            end = length if end < 0 else end + 3
+
+            yield TupleToken(type=HTML_COMMENT, start=start, end=end, name=None, attributes=None)
+        elif match.group(2):
+            end = html.find(">", match.end())
+
+            end = length if end < 0 else end + 1
+
+            yield TupleToken(type=HTML_DECLARATION, start=start, end=end, name=None, attributes=None)
+        elif match.group(3):
+            end = html.find(">", match.end())
+
+            end = length if end < 0 else end + 1
+
+            yield TupleToken(type=HTML_END, start=start, end=end, name=match.group(4).lower(), attributes=None)
+        else:
+            name = match.group(4).lower()
+
+            dict_attribute = dict()
+
+            end = match.end()
+
+            while True:
+                match = PATTERN_HTML_CLOSE.match(html, end)
+
+                if match is not None:
+                    end = match.end()
+
+                    break
+
+                match = PATTERN_HTML_ATTRIBUTE.match(html, end)
+
+                if match is None:
+                    # unterminated tag ends at next '>' if any
+                    end = html.find(">", end)
+
+                    end = length if end < 0 else end + 1
+
+                    break
+
+                end = match.end()
+
+                name_attribute = match.group(1).lower()
+
+                if name_attribute not in dict_attribute:
+                    value = match.group(2)
+
+                    if value is None:
+                        dict_attribute[name_attribute] = TupleAttribute(value="", start=match.end(1), end=match.end(1))
+                    else:
+                        if value[:1] in "\"'":
+                            value = value[1:-1] if len(value) > 1 and value[-1] == value[0] else value[1:]
+
+                        dict_attribute[name_attribute] = TupleAttribute(value=html_unescape(value), start=match.start(2), end=match.end(2))
+
+            yield TupleToken(type=HTML_START, start=start, end=end, name=name, attributes=dict_attribute)
+
+            if name in HTML_RAWTEXT:
+                match = DICT_PATTERN_RAWTEXT[name].search(html, end)
+
+                start = length if match is None else match.start()
+
+                if start > end:
+                    yield TupleToken(type=HTML_TEXT, start=end, end=start, name=name, attributes=None)
+
+                end = start
+
+        index = end
+
+def html_close(list_open, dict_open, name):
+    """
+    Close open element with given name and all elements opened after it (end tags not matching any open element are ignored).
+
+    :type list_open: list
+    :type dict_open: dict
+    :type name: str
+    """
+    if not dict_open.get(name):
+        return
+
+    while True:
+        name_open = list_open.pop()
+
+        dict_open[name_open] -= 1
+
+        if name_open == name:
+            break
+
+def html_ancestors(list_token, index):
+    """
+    Return names of elements open before token at given index mapped to their number of occurrences.
+
+    :type list_token: list
+    :type index: int
+    :rtype: dict
+    """
+    list_open = list()
+    dict_open = Counter()
+
+    for token in islice(list_token, index):
+        if token.type == HTML_START:
+            if token.name not in HTML_VOID:
+                list_open.append(token.name)
+
+                dict_open[token.name] += 1
+        elif token.type == HTML_END:
+            html_close(list_open, dict_open, token.name)
+
+    return dict_open
+
+def html_element_end(list_token, index):
+    """
+    Return index of first token after element started by token at given index (matching end tag included, implicitly closed by end tag of enclosing element or end of document).
+
+    :type list_token: list
+    :type index: int
+    :rtype: int
+    """
+    token = list_token[index]
+
+    if token.name in HTML_VOID:
+        return index + 1
+
+    dict_ancestor = html_ancestors(list_token, index)
+
+    list_open = [ token.name, ]
+    dict_open = Counter(list_open)
+
+    for index in range(index + 1, len(list_token)):
+        token = list_token[index]
+
+        if token.type == HTML_START:
+            if token.name not in HTML_VOID:
+                list_open.append(token.name)
+
+                dict_open[token.name] += 1
+        elif token.type == HTML_END:
+            if dict_open.get(token.name):
+                html_close(list_open, dict_open, token.name)
+
+                if not list_open:
+                    return index + 1
+            elif dict_ancestor.get(token.name):
+                # end tag of enclosing element
+                return index
+
+    return len(list_token)
+
+def edit_attribute(attribute, value):
+    """
+    Create edit replacing value of attribute.
+
+    :type attribute: TupleAttribute
+    :type value: str
+    :rtype: TupleEdit
+    """
+    if attribute.start == attribute.end:
+        return TupleEdit(start=attribute.start, end=attribute.end, replacement=f'="{html_escape(value)}"')
+
+    return TupleEdit(start=attribute.start, end=attribute.end, replacement=f'"{html_escape(value)}"')
+
+def edit_text(token, text):
+    """
+    Create edit replacing text run.
+
+    :type token: TupleToken
+    :type text: str
+    :rtype: TupleEdit
+    """
+    return TupleEdit(start=token.start, end=token.end, replacement=html_escape(text, quote=False))
+
+def edit_element(list_token, index):
+    """
+    Create edit deleting element started by token at given index.
+
+    :type list_token: list
+    :type index: int
+    :rtype: TupleEdit
+    """
+    return TupleEdit(start=list_token[index].start, end=list_token[html_element_end(list_token, index) - 1].end, replacement="")
+
+def apply_edits(content, list_edit):
+    """
+    Apply edits as splice over original string (edits overlapping an earlier edit are skipped).
+
+    :type content: str
+    :type list_edit: list
+    :rtype: str
+    """
+    list_content = list()
+
+    index = 0
+
+    for edit in sorted(list_edit, key=lambda edit: ( edit.start, -edit.end )):
+        if edit.start < index:
+            continue
+
+        list_content.append(content[index:edit.start])
+        list_content.append(edit.replacement)
+
+        index = edit.end
+
+    list_content.append(content[index:])
+
+    return "".join(list_content)
+
 def string_ascii(string):
     """
     Check whether string is ASCII.
@@ -991,6 +1363,22 @@ def scan_avira(path_file):
 
     return None
 
+def scan_file(list_scan, path_file):
+    """
+    Scan file with AV scanners and return name of virus found (None if no virus found).
+
+    :type list_scan: list
+    :type path_file: str
+    :rtype: str or None
+    """
+    for scan in list_scan:
+        virus_found = scan(path_file)
+
+        if virus_found is not None:
+            return virus_found
+
+    return None
+
 def domain_blacklisted(domain):
     """
     Check domain against reputation blacklists.
@@ -1032,43 +1420,163 @@ def url2regex(url):
     else:
         return fr"^{protocol}{escape(url).replace(r"\*", r".*")}$"
 
-def extract_part(email, content_subtype):
+def iter_payload(part):
     """
-    Extract part, charset and content for first non-attachment text part matching given content subtype.
+    Yield decoded payload of part in chunks (base64 and quoted-printable are decoded incrementally, other encodings in one go).
 
-    :type email: EmailMessage
+    :type part: email.message.EmailMessage
+    :rtype: iterator
+    """
+    payload = part.get_payload()
+
+    encoding = part.get("content-transfer-encoding", "").strip().lower()
+
+    if not isinstance(payload, str) or encoding not in { "base64", "quoted-printable" }:
+        data = part.get_payload(decode=True)
+
+        if data is not None:
+            yield data
+
+        return
+
+    remainder = b""
+
+    for index in range(0, len(payload), SIZE_PAYLOAD_CHUNK):
+        chunk = remainder + payload[index:index + SIZE_PAYLOAD_CHUNK].encode("ascii", "surrogateescape")
+
+        if encoding == "base64":
+            chunk = chunk.translate(None, DELETE_BASE64)
+
+            # only decode complete 4 character groups
+            cut = len(chunk) & ~3
+        else:
+            # only decode complete lines so escape sequences and soft line breaks are not split
+            cut = chunk.rfind(b"\n") + 1
+
+        remainder = chunk[cut:]
+
+        if cut:
+            yield a2b_base64(chunk[:cut]) if encoding == "base64" else a2b_qp(chunk[:cut])
+
+    if remainder:
+        if encoding == "base64":
+            # a single trailing character cannot be decoded
+            if len(remainder) % 4 > 1:
+                yield a2b_base64(remainder + b"=" * (-len(remainder) % 4))
+        else:
+            yield a2b_qp(remainder)
+
+def combinable_regex(regex, name):
+    """
+    Return regex wrapped in named group for combination with other regex into single alternation (None if regex refers to groups by number or name, which would refer to wrong group in alternation). Global inline flags are converted to flags scoped to the group.
+
+    :type regex: str
+    :type name: str
+    :rtype: str or None
+    """
+    if search(PATTERN_GROUP_REFERENCE, regex) is not None:
+        return None
+
+    match = search(PATTERN_GLOBAL_FLAGS, regex)
+
+    if match is not None:
+        regex = f"(?{match.group(1)}:{regex[match.end():]})"
+
+    return f"(?P<{name}>{regex})"
+
+def decode_part(part, content_subtype):
+    """
+    Decode content of text part and return charset and content.
+
+    The declared charset (US-ASCII if none declared) is tried strictly first and charset detection only used if that fails. The result is memoized per part in DICT_DECODED together with the decoding path taken (see decode_path) and reused as long as the part returns the same payload object and declared charset (get_payload returns a new string for raw 8bit payloads, so these are decoded again).
+
+    :type part: EmailMessage
     :type content_subtype: str
-    :rtype: tuple or None
+    :rtype: tuple
     """
+    payload = part.get_payload()
+
+    declared = part.get_content_charset()
+
+    decoded = DICT_DECODED.get(part)
+
+    if decoded is not None and decoded.payload is payload and decoded.declared == declared:
+        return (decoded.charset, decoded.content)
+
     content_type = f"text/{content_subtype}"
 
-    for part in email.walk():
-        if part.get_content_type() == content_type and not part.is_attachment():
-            try:
-                content = part.get_payload(decode=True)
-            except Exception:
-                raise Exception(f"Cannot extract '{content_type}' body from message")
+    try:
+        content = part.get_payload(decode=True)
+    except Exception:
+        raise Exception(f"Cannot extract '{content_type}' body from message")
+
+    if not content:
+        return (CHARSET_UTF8, "")
 
-            if not content:
-                return(part, CHARSET_UTF8, "")
+    charset = python_charset(declared or "ascii")
 
-            charset = part.get_content_charset()
+    try:
+        decoded = TupleDecoded(payload=payload, declared=declared, charset=charset, content=content.decode(charset), path=DECODE_DECLARED)
+    except (LookupError, UnicodeDecodeError):
+        html = (content_subtype == TYPE_HTML)
 
-            html = (content_subtype == TYPE_HTML)
+        if declared is None:
+            unicode = UnicodeDammit(content, is_html=html)
+        else:
+            unicode = UnicodeDammit(content, [ declared, ], is_html=html)
 
-            if charset is None:
-                unicode = UnicodeDammit(text, is_html=html)
-            else:
-                unicode = UnicodeDammit(text, [ charset, ], is_html=html)
+        if unicode.unicode_markup is None:
+            raise Exception(f"Cannot decode '{content_type}' body")
 
-            content = unicode.unicode_markup
+        decoded = TupleDecoded(payload=payload, declared=declared, charset=python_charset(unicode.original_encoding), content=unicode.unicode_markup, path=DECODE_DETECTED)
 
-            if content is None:
-                raise Exception(f"Cannot decode '{content_type}' body")
+    DICT_DECODED[part] = decoded
 
-            return (part, python_charset(unicode.original_encoding), content)
+    return (decoded.charset, decoded.content)
 
-    return None
+def decode_path(part):
+    """
+    Return decoding path taken for text part by decode_part (DECODE_DECLARED or DECODE_DETECTED, None if not decoded yet).
+
+    :type part: EmailMessage
+    :rtype: str or None
+    """
+    decoded = DICT_DECODED.get(part)
+
+    if decoded is None:
+        return None
+
+    return decoded.path
+
+def iter_parts(email, list_subtype, nested=False):
+    """
+    Walk MIME tree once and yield part, charset and content for all non-attachment text parts matching given content subtypes (optionally including parts of attached messages).
+
+    :type email: EmailMessage
+    :type list_subtype: list
+    :type nested: bool
+    :rtype: generator
+    """
+    list_part = [ email, ]
+
+    while list_part:
+        part = list_part.pop()
+
+        if part.is_multipart():
+            if nested or part is email or part.get_content_type() != "message/rfc822":
+                list_part.extend(reversed(part.get_payload()))
+        elif part.get_content_maintype() == "text" and part.get_content_subtype() in list_subtype and not part.is_attachment():
+            yield (part, *decode_part(part, part.get_content_subtype()))
+
+def extract_part(email, content_subtype):
+    """
+    Extract part, charset and content for first non-attachment text part matching given content subtype.
+
+    :type email: EmailMessage
+    :type content_subtype: str
+    :rtype: tuple or None
+    """
+    return next(iter_parts(email, ( content_subtype, ), nested=True), None)
 
 def annotate_html(content, annotation, on_top=True):
     """
@@ -1137,3 +1645,209 @@ def url_blacklisted(url, set_whitelist, set_blacklist):
         domain = domain[index + 1:]
 
     return None
+
+def otsu_threshold(histogram):
+    """
+    Return binarization threshold maximizing between-class variance of grayscale histogram (Otsu's method).
+
+    :type histogram: list
+    :rtype: int
+    """
+    count_total = sum(histogram)
+    sum_total = sum(value * count for (value, count) in enumerate(histogram))
+
+    count_background = 0
+    sum_background = 0
+
+    variance_max = 0
+    threshold = 127
+
+    for (value, count) in enumerate(histogram):
+        count_background += count
+
+        if count_background == 0:
+            continue
+
+        count_foreground = count_total - count_background
+
+        if count_foreground == 0:
+            break
+
+        sum_background += value * count
+
+        variance = count_background * count_foreground * (sum_background / count_background - (sum_total - sum_background) / count_foreground) ** 2
+
+        if variance > variance_max:
+            variance_max = variance
+            threshold = value
+
+    return threshold
+
+def image_keys(data, image=None, settings=None):
+    """
+    Return cache keys for image, exact content hash first and optionally difference hash (dHash) of downscaled grayscale image (prefixed with hash of settings the result depends on if given).
+
+    :type data: bytes
+    :type image: PIL.Image.Image or None
+    :type settings: tuple or None
+    :rtype: list
+    """
+    list_key = [ sha256(data).hexdigest(), ]
+
+    if image is not None:
+        try:
+            pixels = image.convert("L").resize((SIZE_DHASH + 1, SIZE_DHASH)).tobytes()
+        except Exception:
+            # unsupported image mode, fall back to exact hash
+            pixels = None
+
+        if pixels is not None:
+            dhash = 0
+
+            for row in range(SIZE_DHASH):
+                offset = row * (SIZE_DHASH + 1)
+
+                for column in range(SIZE_DHASH):
+                    dhash = dhash << 1 | (pixels[offset + column] > pixels[offset + column + 1])
+
+            list_key.append(f"dhash-{dhash:0{SIZE_DHASH * SIZE_DHASH // 4}x}")
+
+    if settings is not None:
+        prefix = sha256(repr(settings).encode()).hexdigest()[:16]
+
+        list_key = [ f"{prefix}-{key}" for key in list_key ]
+
+    return list_key
+
+def cache_trusted(path_dir):
+    """
+    Check whether cache directory exists, is owned by current user and not writable by others (cache files in directories other users can write to, including symlinked directories, are not trusted).
+
+    :type path_dir: Path
+    :rtype: bool
+    """
+    try:
+        stat_dir = path_dir.lstat()
+    except Exception:
+        return False
+
+    return S_ISDIR(stat_dir.st_mode) and stat_dir.st_uid == getuid() and not stat_dir.st_mode & 0o022
+
+def write_cache(path_dir, name, data):
+    """
+    Write data to file in cache directory (created if missing), atomically replacing existing file. Return whether file was written (caching is best effort, so errors and directories not owned by current user are ignored).
+
+    :type path_dir: Path
+    :type name: str
+    :type data: bytes or str
+    :rtype: bool
+    """
+    try:
+        path_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    except Exception:
+        return False
+
+    if not cache_trusted(path_dir):
+        return False
+
+    if isinstance(data, str):
+        data = data.encode()
+
+    path_tmp = None
+
+    try:
+        with NamedTemporaryFile(dir=path_dir, suffix=".tmp", delete=False) as f:
+            path_tmp = Path(f.name)
+
+            f.write(data)
+
+        path_tmp.replace(path_dir.joinpath(name))
+    except Exception:
+        if path_tmp is not None:
+            path_tmp.unlink(missing_ok=True)
+
+        return False
+
+    return True
+
+def prune_cache(path_dir, max_age, max_files):
+    """
+    Remove cache files older than maximum age and oldest files exceeding maximum number of files (hidden files are kept).
+
+    :type path_dir: Path
+    :type max_age: int
+    :type max_files: int
+    """
+    time_now = time()
+
+    list_file = list()
+
+    for path_file in path_dir.iterdir():
+        if path_file.name.startswith("."):
+            continue
+
+        try:
+            time_modified = path_file.stat().st_mtime
+        except Exception:
+            continue
+
+        if time_now - time_modified > max_age:
+            path_file.unlink(missing_ok=True)
+        else:
+            list_file.append(( time_modified, path_file ))
+
+    if len(list_file) > max_files:
+        list_file.sort()
+
+        for (_, path_file) in list_file[:len(list_file) - max_files]:
+            path_file.unlink(missing_ok=True)
+
+def cached_result(namespace, list_key):
+    """
+    Return cached image result for first matching key together with whether it was found by exact content hash (None if not cached).
+
+    Results found by perceptual hash may belong to a different but similar image, so they must only be used to confirm a detection.
+
+    :type namespace: str
+    :type list_key: list
+    :rtype: tuple or None
+    """
+    dir_cache = DIR_IMAGE_CACHE.joinpath(namespace)
+
+    if not cache_trusted(dir_cache):
+        return None
+
+    for (index, key) in enumerate(list_key):
+        try:
+            return ( json_loads(dir_cache.joinpath(f"{key}.json").read_text()), index == 0 )
+        except Exception:
+            pass
+
+    return None
+
+def cache_result(namespace, list_key, result):
+    """
+    Cache image result under all keys and prune outdated results from time to time.
+
+    :type namespace: str
+    :type list_key: list
+    :type result: object
+    """
+    dir_cache = DIR_IMAGE_CACHE.joinpath(namespace)
+
+    content = json_dumps(result)
+
+    for key in list_key:
+        if not write_cache(dir_cache, f"{key}.json", content):
+            return
+
+    try:
+        time_pruned = dir_cache.joinpath(FILE_PRUNED).stat().st_mtime
+    except Exception:
+        time_pruned = 0
+
+    if time() - time_pruned > INTERVAL_PRUNE and write_cache(dir_cache, FILE_PRUNED, ""):
+        try:
+            prune_cache(dir_cache, AGE_IMAGE_CACHE, MAX_IMAGE_CACHE)
+        except Exception:
+            pass
@@ -1,15 +1,108 @@
-# decrypt_pdf.py V6.1.1
+# decrypt_pdf.py V6.3.1
 #
 # Copyright (c) 2021-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
-from tempfile import NamedTemporaryFile
-from shutil import copyfile
-from fitz import open as fitz
+from pathlib import Path
+from tempfile import TemporaryDirectory, NamedTemporaryFile
+from functools import partial
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fitz import open as fitz, PDF_ENCRYPT_NONE, PDF_ANNOT_FILE_ATTACHMENT
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "password_list", "scan_sophos", "scan_kaspersky", "scan_avira", "remove_encryption" )
+CONFIG_PARAMETERS = ( "password_list", "scan_sophos", "scan_kaspersky", "scan_avira", "remove_encryption", "scan_embedded", "max_objects", "max_size" )
+
+MAX_WORKERS = 4
+
+TupleLimits = namedtuple("TupleLimits", "max_objects max_size")
+
+def embedded_objects(pdf_file):
+    """
+    Generator yielding name, declared size and content getter of embedded files and file attachment annotations of PDF.
+
+    :type pdf_file: Document
+    :rtype: generator
+    """
+    for index in range(pdf_file.embfile_count()):
+        info = pdf_file.embfile_info(index)
+
+        yield (info["filename"], info["size"], partial(pdf_file.embfile_get, index))
+
+    for page in pdf_file:
+        for annot in page.annots(types=( PDF_ANNOT_FILE_ATTACHMENT, )):
+            info = annot.file_info
+
+            yield (info["filename"], info["size"], annot.get_file)
+
+def extract_objects(pdf_file, path_tmpdir, limits):
+    """
+    Extract embedded files and file attachment annotations of PDF to temp dir, abandoning extraction as soon as number or total size of objects exceed limits. Return list of extracted files.
+
+    :type pdf_file: Document
+    :type path_tmpdir: Path
+    :type limits: TupleLimits
+    :rtype: list
+    """
+    list_file = list()
+
+    size_total = 0
+
+    for (index, (name, size, get_content)) in enumerate(embedded_objects(pdf_file)):
+        if limits.max_objects and index >= limits.max_objects:
+            raise Exception("Number of embedded objects exceeds limit")
+
+        # declared size is checked before decompressing content
+        if limits.max_size and size_total + max(size, 0) > limits.max_size:
+            raise Exception(f"Size of embedded object '{name}' exceeds limit")
+
+        try:
+            content = get_content()
+        except Exception:
+            raise Exception(f"Cannot extract embedded object '{name}'")
+
+        size_total += len(content)
+
+        if limits.max_size and size_total > limits.max_size:
+            raise Exception(f"Size of embedded object '{name}' exceeds limit")
+
+        # object names are not used as paths to avoid path traversal
+        path_file = path_tmpdir.joinpath(str(index))
+
+        path_file.write_bytes(content)
+
+        list_file.append(str(path_file))
+
+    return list_file
+
+def scan_files(list_scan, list_file):
+    """
+    Scan files with AV scanners concurrently and return name of first virus found (None if no virus found).
+
+    :type list_scan: list
+    :type list_file: list
+    :rtype: str or None
+    """
+    if not list_scan:
+        return None
+
+    if len(list_file) == 1:
+        return scan_file(list_scan, list_file[0])
+
+    executor = ThreadPoolExecutor(max_workers=min(len(list_file), MAX_WORKERS))
+
+    try:
+        for future in as_completed([ executor.submit(scan_file, list_scan, path_file) for path_file in list_file ]):
+            virus_found = future.result()
+
+            if virus_found is not None:
+                return virus_found
+    finally:
+        # running scans are waited for as extracted files are removed afterwards
+        executor.shutdown(cancel_futures=True)
+
+    return None
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
@@ -61,26 +154,49 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     if config.scan_avira:
         list_scan.append(scan_avira)
 
+    limits = TupleLimits(max_objects=config.max_objects, max_size=config.max_size * 1048576)
+
+    # decrypted PDF only needs to be saved for scanning or removing encryption
     if list_scan or config.remove_encryption:
-        virus_found = None
+        # decrypted PDF is written next to input so it can atomically replace it
+        with NamedTemporaryFile(dir=Path(input).parent, suffix=".tmp", delete=False) as f:
+            path_file = Path(f.name)
 
-        with NamedTemporaryFile(dir="/tmp") as path_tmpfile:
-            path_file = path_tmpfile.name
+        try:
+            with TemporaryDirectory(dir=DIR_EXTRACT) as path_tmpdir:
+                path_tmpdir = Path(path_tmpdir)
 
-            pdf_file.save(path_file)
+                if config.scan_avira:
+                    path_tmpdir.chmod(0o755)
 
-            pdf_file.close()
+                try:
+                    # no garbage collection or recompression of streams for speed
+                    pdf_file.save(path_file, garbage=0, clean=False, deflate=False, encryption=PDF_ENCRYPT_NONE)
+                except Exception:
+                    pdf_file.close()
+
+                    write_log(log, "Cannot save decrypted PDF file")
+
+                    return ReturnCode.DETECTED
+
+                list_file = [ str(path_file), ]
 
-            for scan in list_scan:
                 try:
-                    virus_found = scan(path_file)
+                    if list_scan and config.scan_embedded:
+                        list_file.extend(extract_objects(pdf_file, path_tmpdir, limits))
                 except Exception as ex:
                     write_log(log, ex)
 
                     return ReturnCode.DETECTED
+                finally:
+                    pdf_file.close()
+
+                try:
+                    virus_found = scan_files(list_scan, list_file)
+                except Exception as ex:
+                    write_log(log, ex)
 
-                if virus_found is not None:
-                    break
+                    return ReturnCode.DETECTED
 
             if virus_found is not None:
                 write_log(log, f"Virus '{virus_found}'")
@@ -88,8 +204,19 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
                 return ReturnCode.DETECTED
 
             if config.remove_encryption:
-                copyfile(path_file, input)
+                try:
+                    path_file.chmod(Path(input).stat().st_mode & 0o777)
+
+                    path_file.replace(input)
+                except Exception:
+                    write_log(log, f"Cannot replace '{input}'")
+
+                    return ReturnCode.DETECTED
 
                 return ReturnCode.MODIFIED
+        finally:
+            path_file.unlink(missing_ok=True)
+    else:
+        pdf_file.close()
 
     return ReturnCode.NONE
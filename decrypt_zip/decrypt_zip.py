@@ -1,16 +1,461 @@
-# decrypt_zip.py V7.1.0
+# decrypt_zip.py V7.5.4
 #
 # Copyright (c) 2021-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
 from pathlib import Path
-from io import BytesIO
-from tempfile import TemporaryDirectory
-from pyzipper import AESZipFile, ZIP_LZMA, WZ_AES
+from tempfile import TemporaryDirectory, NamedTemporaryFile
+from shutil import copyfileobj, rmtree
+from zlib import error as ZlibError
+from lzma import LZMAError
+from struct import Struct
+from collections import namedtuple
+from hashlib import sha256, pbkdf2_hmac
+from json import dumps as json_dumps, loads as json_loads
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pyzipper import AESZipFile, BadZipFile, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, WZ_AES
+from pyzipper.zipfile_aes import AESZipInfo
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "password_list", "scan_sophos", "scan_kaspersky", "scan_avira", "remove_encryption" )
+CONFIG_PARAMETERS = ( "password_list", "scan_sophos", "scan_kaspersky", "scan_avira", "remove_encryption", "compression", "compression_level", "max_depth", "max_size", "max_members", "max_ratio" )
+
+MAX_WORKERS = 4
+
+COMPRESSION_SOURCE = "source"
+
+DICT_COMPRESSION = { "stored": ZIP_STORED, "deflate": ZIP_DEFLATED, "bzip2": ZIP_BZIP2, "lzma": ZIP_LZMA }
+
+SIZE_POOL = 1000 # minimum number of passwords for verification in process pool
+
+MAX_VERIFY = 3 # maximum number of members for password verification
+
+DIR_CACHE = Path("/tmp/decrypt_zip")
+
+SIZE_CHUNK = 1048576 # in bytes
+
+SIZE_RATIO = 1048576 # minimum decompressed size of member for compression ratio check in bytes
+
+FILE_HITS = "hits.json"
+
+STRUCT_LOCAL_HEADER = Struct("<4s5H3L2H")
+STRUCT_EXTRA = Struct("<2H")
+
+SIGNATURE_LOCAL_HEADER = b"PK\x03\x04"
+
+# members identifying ZIP based document and package formats (OOXML, ODF, JAR, APK)
+SET_DOCUMENT_MEMBER = { "[Content_Types].xml", "mimetype", "META-INF/MANIFEST.MF", "AndroidManifest.xml" }
+
+ID_EXTRA_AES = 0x9901
+
+FLAG_ENCRYPTED = 0x1
+FLAG_DATA_DESCRIPTOR = 0x8
+FLAG_STRONG_ENCRYPTION = 0x40
+
+# wrong password passing the password check fails on decompression (bzip2 raises OSError, truncated streams EOFError), only caught around reading source members
+TUPLE_PASSWORD_ERROR = ( RuntimeError, BadZipFile, ZlibError, LZMAError, OSError, EOFError )
+
+SIZE_ZIPCRYPTO_HEADER = 12 # in bytes
+
+DICT_AES_KEY = { 1: 16, 2: 24, 3: 32 } # AES strength and key length in bytes
+
+ITERATIONS_AES = 1000
+
+METHOD_ZIPCRYPTO = "zipcrypto"
+METHOD_AES = "aes"
+
+TupleVerifier = namedtuple("TupleVerifier", "method data check")
+TupleOutput = namedtuple("TupleOutput", "zf compression compression_level")
+TupleLimits = namedtuple("TupleLimits", "max_depth max_size max_members max_ratio")
+
+class ExceptionWrongPassword(Exception):
+    """
+    Custom exception for errors raised while decrypting or decompressing a member (only these indicate a wrong password).
+    """
+    def __init__(self, name_member):
+        """
+        :type name_member: str
+        """
+        super().__init__(f"Cannot decrypt member '{name_member}'")
+
+def crc_table():
+    """
+    Return CRC-32 lookup table used by ZipCrypto key update.
+
+    :rtype: list
+    """
+    list_crc = list()
+
+    for index in range(256):
+        crc = index
+
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xEDB88320 if crc & 1 else crc >> 1
+
+        list_crc.append(crc)
+
+    return list_crc
+
+TABLE_CRC = crc_table()
+
+def zipcrypto_check(password, header):
+    """
+    Decrypt ZipCrypto encryption header with password and return last byte (check byte).
+
+    :type password: bytes
+    :type header: bytes
+    :rtype: int
+    """
+    key_0 = 0x12345678
+    key_1 = 0x23456789
+    key_2 = 0x34567890
+
+    for byte in password:
+        key_0 = (key_0 >> 8) ^ TABLE_CRC[(key_0 ^ byte) & 0xFF]
+        key_1 = ((key_1 + (key_0 & 0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+        key_2 = (key_2 >> 8) ^ TABLE_CRC[(key_2 ^ (key_1 >> 24)) & 0xFF]
+
+    for byte in header:
+        temp = key_2 | 2
+
+        byte ^= ((temp * (temp ^ 1)) >> 8) & 0xFF
+
+        key_0 = (key_0 >> 8) ^ TABLE_CRC[(key_0 ^ byte) & 0xFF]
+        key_1 = ((key_1 + (key_0 & 0xFF)) * 134775813 + 1) & 0xFFFFFFFF
+        key_2 = (key_2 >> 8) ^ TABLE_CRC[(key_2 ^ (key_1 >> 24)) & 0xFF]
+
+    return byte
+
+def read_verifiers(path_zip, list_info):
+    """
+    Read password verification data (ZipCrypto check byte or WinZip AES password verifier) of first encrypted members from local headers.
+
+    :type path_zip: str
+    :type list_info: list
+    :rtype: list
+    """
+    list_verifier = list()
+
+    with open(path_zip, "rb") as f:
+        for info in list_info:
+            if not info.flag_bits & FLAG_ENCRYPTED or info.flag_bits & FLAG_STRONG_ENCRYPTION:
+                continue
+
+            f.seek(info.header_offset)
+
+            header = f.read(STRUCT_LOCAL_HEADER.size)
+
+            if len(header) < STRUCT_LOCAL_HEADER.size:
+                continue
+
+            (signature, _, _, compression, mod_time, _, _, _, _, length_name, length_extra) = STRUCT_LOCAL_HEADER.unpack(header)
+
+            if signature != SIGNATURE_LOCAL_HEADER:
+                continue
+
+            f.seek(length_name, 1)
+
+            extra = f.read(length_extra)
+
+            strength = None
+
+            index = 0
+
+            while index + STRUCT_EXTRA.size <= len(extra):
+                (id_extra, size_extra) = STRUCT_EXTRA.unpack_from(extra, index)
+
+                if id_extra == ID_EXTRA_AES and size_extra >= 5:
+                    strength = extra[index + STRUCT_EXTRA.size + 4]
+
+                index += STRUCT_EXTRA.size + size_extra
+
+            if strength is not None:
+                if strength not in DICT_AES_KEY:
+                    continue
+
+                length_key = DICT_AES_KEY[strength]
+
+                # salt is followed by 2 byte password verifier
+                data = f.read(length_key // 2 + 2)
+
+                if len(data) == length_key // 2 + 2:
+                    list_verifier.append(TupleVerifier(method=METHOD_AES, data=data[:-2], check=(length_key, data[-2:])))
+            else:
+                data = f.read(SIZE_ZIPCRYPTO_HEADER)
+
+                if len(data) == SIZE_ZIPCRYPTO_HEADER:
+                    check = (mod_time >> 8) & 0xFF if info.flag_bits & FLAG_DATA_DESCRIPTOR else info.CRC >> 24
+
+                    list_verifier.append(TupleVerifier(method=METHOD_ZIPCRYPTO, data=data, check=check))
+
+            if len(list_verifier) >= MAX_VERIFY:
+                break
+
+    return list_verifier
+
+def password_verified(password, list_verifier):
+    """
+    Check password against verification data of encrypted members without decompressing (ZipCrypto check byte has false positives, so password still needs to be confirmed by extraction).
+
+    :type password: bytes
+    :type list_verifier: list
+    :rtype: bool
+    """
+    for verifier in list_verifier:
+        if verifier.method == METHOD_AES:
+            (length_key, password_verifier) = verifier.check
+
+            if pbkdf2_hmac("sha1", password, verifier.data, ITERATIONS_AES, dklen=2 * length_key + 2)[-2:] != password_verifier:
+                return False
+        elif zipcrypto_check(password, verifier.data) != verifier.check:
+            return False
+
+    return True
+
+def filter_passwords(list_password, list_verifier):
+    """
+    Return passwords passing verification in original order.
+
+    :type list_password: list
+    :type list_verifier: list
+    :rtype: list
+    """
+    return [ password for password in list_password if password_verified(password.encode(), list_verifier) ]
+
+def candidate_passwords(list_password, list_verifier):
+    """
+    Return candidate passwords passing verification, large password lists are verified in process pool.
+
+    :type list_password: list
+    :type list_verifier: list
+    :rtype: list
+    """
+    if not list_verifier:
+        return list_password
+
+    if len(list_password) < SIZE_POOL:
+        return filter_passwords(list_password, list_verifier)
+
+    size_chunk = -(-len(list_password) // MAX_WORKERS)
+
+    list_chunk = [ list_password[index:index + size_chunk] for index in range(0, len(list_password), size_chunk) ]
+
+    # command module is loaded into __main__, so worker processes must be forked
+    with ProcessPoolExecutor(max_workers=len(list_chunk), mp_context=get_context("fork")) as executor:
+        return [ password for list_result in executor.map(filter_passwords, list_chunk, [ list_verifier ] * len(list_chunk)) for password in list_result ]
+
+def password_key(password):
+    """
+    Return key of password in hit-frequency table (passwords are not stored in plain text).
+
+    :type password: str
+    :rtype: str
+    """
+    return sha256(password.encode()).hexdigest()
+
+def load_hits():
+    """
+    Load persisted hit-frequency table of passwords.
+
+    :rtype: dict
+    """
+    if cache_trusted(DIR_CACHE):
+        try:
+            return json_loads(DIR_CACHE.joinpath(FILE_HITS).read_text())
+        except Exception:
+            pass
+
+    return dict()
+
+def record_hit(dict_hits, password):
+    """
+    Increase hit count of password and persist hit-frequency table.
+
+    :type dict_hits: dict
+    :type password: str
+    """
+    key = password_key(password)
+
+    dict_hits[key] = dict_hits.get(key, 0) + 1
+
+    write_cache(DIR_CACHE, FILE_HITS, json_dumps(dict_hits))
+
+def finish_member(member, output):
+    """
+    Wait for scan result of extracted member and stream member to decrypted ZIP container (if no virus found). Return name of virus found (None if no virus found).
+
+    :type member: tuple
+    :type output: TupleOutput or None
+    :rtype: str or None
+    """
+    (info, path_file, future) = member
+
+    if future is not None:
+        virus_found = future.result()
+
+        if virus_found is not None:
+            return virus_found
+
+    if output is not None:
+        # AESZipFile only accepts its own ZipInfo class, any other object is taken for a file name
+        info_decrypted = AESZipInfo(info.filename, date_time=info.date_time)
+
+        info_decrypted.external_attr = info.external_attr
+
+        if output.compression is None:
+            # keep compression method of member if supported
+            info_decrypted.compress_type = info.compress_type if info.compress_type in DICT_COMPRESSION.values() else ZIP_DEFLATED
+        else:
+            info_decrypted.compress_type = output.compression
+
+        # no public attribute for compression level of ZipInfo in pyzipper
+        info_decrypted._compresslevel = output.compression_level
+        # decides whether ZIP64 is needed
+        info_decrypted.file_size = info.file_size
+
+        try:
+            if path_file is None:
+                output.zf.writestr(info_decrypted, b"")
+            else:
+                with open(path_file, "rb") as f_source, output.zf.open(info_decrypted, "w") as f_target:
+                    copyfileobj(f_source, f_target, SIZE_CHUNK)
+        except Exception:
+            raise Exception(f"Cannot write '{info.filename}' to decrypted ZIP container")
+
+    if path_file is not None:
+        path_file.unlink()
+
+    return None
+
+def copy_member(f_source, f_target, info, limits, counter):
+    """
+    Copy decompressed member in chunks, abandoning extraction as soon as total decompressed size or compression ratio exceed limits.
+
+    :type f_source: ZipExtFile
+    :type f_target: file
+    :type info: AESZipInfo
+    :type limits: TupleLimits
+    :type counter: dict
+    """
+    size = 0
+
+    while True:
+        try:
+            chunk = f_source.read(SIZE_CHUNK)
+        except TUPLE_PASSWORD_ERROR:
+            raise ExceptionWrongPassword(info.filename)
+
+        if not chunk:
+            break
+
+        size += len(chunk)
+
+        counter["size"] += len(chunk)
+
+        if limits.max_size and counter["size"] > limits.max_size:
+            raise Exception("Decompressed size exceeds limit")
+
+        if limits.max_ratio and size > SIZE_RATIO and size > limits.max_ratio * info.compress_size:
+            raise Exception(f"Compression ratio of '{info.filename}' exceeds limit")
+
+        try:
+            f_target.write(chunk)
+        except Exception:
+            raise Exception(f"Cannot extract file '{info.filename}'")
+
+def zip_container(path_file):
+    """
+    Check whether file is ZIP container (ZIP based document and package formats like OOXML, ODF and JAR are not treated as containers).
+
+    :type path_file: Path
+    :rtype: bool
+    """
+    with open(path_file, "rb") as f:
+        if f.read(len(SIGNATURE_LOCAL_HEADER)) != SIGNATURE_LOCAL_HEADER:
+            return False
+
+    try:
+        with AESZipFile(path_file, "r") as zf:
+            return SET_DOCUMENT_MEMBER.isdisjoint(zf.namelist())
+    except Exception:
+        # malformed ZIP container is scanned as ordinary file
+        return False
+
+def extract_members(zf, path_tmpdir, list_scan, output, limits, counter, depth=0):
+    """
+    Extract members of ZIP container (and nested ZIP containers up to maximum depth) in chunks to temp dir, scan each member while the next one is extracted and stream scanned members to decrypted ZIP container (if given). Return name of virus found (None if no virus found).
+
+    :type zf: AESZipFile
+    :type path_tmpdir: Path
+    :type list_scan: list
+    :type output: TupleOutput or None
+    :type limits: TupleLimits
+    :type counter: dict
+    :type depth: int
+    :rtype: str or None
+    """
+    member = None
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for (index, info) in enumerate(zf.infolist()):
+            counter["members"] += 1
+
+            if limits.max_members and counter["members"] > limits.max_members:
+                raise Exception("Number of members exceeds limit")
+
+            if info.is_dir():
+                path_file = None
+            else:
+                # member names are not used as paths to avoid path traversal
+                path_file = path_tmpdir.joinpath(str(index))
+
+                try:
+                    f_source = zf.open(info)
+                except TUPLE_PASSWORD_ERROR:
+                    raise ExceptionWrongPassword(info.filename)
+
+                with f_source:
+                    try:
+                        f_target = open(path_file, "wb")
+                    except Exception:
+                        raise Exception(f"Cannot extract file '{info.filename}'")
+
+                    with f_target:
+                        copy_member(f_source, f_target, info, limits, counter)
+
+                if depth < limits.max_depth and zip_container(path_file):
+                    path_nested = path_tmpdir.joinpath(f"{index}.d")
+
+                    path_nested.mkdir()
+
+                    try:
+                        with AESZipFile(path_file, "r", encryption=WZ_AES) as zf_nested:
+                            # nested ZIP containers are usually encrypted with same password
+                            zf_nested.pwd = zf.pwd
+
+                            virus_found = extract_members(zf_nested, path_nested, list_scan, None, limits, counter, depth + 1)
+                    except ( ExceptionWrongPassword, BadZipFile ):
+                        # malformed or differently encrypted nested ZIP container is only scanned as ordinary file
+                        virus_found = None
+
+                    if virus_found is not None:
+                        return virus_found
+
+                    rmtree(path_nested, ignore_errors=True)
+
+            if member is not None:
+                virus_found = finish_member(member, output)
+
+                if virus_found is not None:
+                    return virus_found
+
+            member = (info, path_file, executor.submit(scan_file, list_scan, str(path_file)) if list_scan and path_file is not None else None)
+
+        if member is not None:
+            return finish_member(member, output)
+
+    return None
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
@@ -25,17 +470,30 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     :type reformat_header: bool
     """
     try:
-        set_password = set(lexical_list(config.password_list))
+        list_password = list(dict.fromkeys(lexical_list(config.password_list)))
     except Exception as ex:
         write_log(log, ex)
 
         return ReturnCode.DETECTED
 
-    if not set_password:
+    if not list_password:
         write_log(log, "Password list is empty")
 
         return ReturnCode.DETECTED
 
+    if config.compression == COMPRESSION_SOURCE:
+        compression = None
+    elif config.compression in DICT_COMPRESSION:
+        compression = DICT_COMPRESSION[config.compression]
+    else:
+        write_log(log, f"Unknown compression method '{config.compression}'")
+
+        return ReturnCode.DETECTED
+
+    compression_level = None if config.compression_level < 0 else config.compression_level
+
+    limits = TupleLimits(max_depth=config.max_depth, max_size=config.max_size * 1048576, max_members=config.max_members, max_ratio=config.max_ratio)
+
     list_scan = list()
 
     if config.scan_sophos:
@@ -47,71 +505,86 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     if config.scan_avira:
         list_scan.append(scan_avira)
 
-    virus_found = None
-
-    if config.remove_encryption:
-        buffer = BytesIO()
-
-        zf_decrypted = AESZipFile(buffer, "w", compression=ZIP_LZMA)
-
-    with TemporaryDirectory(dir="/tmp") as path_tmpdir:
+    with TemporaryDirectory(dir=DIR_EXTRACT) as path_tmpdir:
         path_tmpdir = Path(path_tmpdir)
 
         if config.scan_avira:
             path_tmpdir.chmod(0o755)
 
         with AESZipFile(input, "r", compression=ZIP_LZMA, encryption=WZ_AES) as zf:
-            for password in set_password:
-                try:
-                    zf.pwd = password.encode()
+            dict_hits = load_hits()
 
-                    for file_name in zf.namelist():
-                        path_file = path_tmpdir.joinpath(file_name)
+            # most successful passwords first
+            list_password = sorted(list_password, key=lambda password: dict_hits.get(password_key(password), 0), reverse=True)
 
-                        data = zf.read(file_name)
+            try:
+                list_password = candidate_passwords(list_password, read_verifiers(input, zf.infolist()))
+            except Exception as ex:
+                write_log(log, ex)
 
-                        try:
-                            with open(path_file, "wb") as f:
-                                f.write(data)
-                        except Exception:
-                            write_log(log, f"Cannot extract file '{file_name}'")
+                return ReturnCode.DETECTED
 
-                            return ReturnCode.DETECTED
+            for password in list_password:
+                zf.pwd = password.encode()
 
-                        path_file = str(path_file)
+                path_output = None
 
-                        for scan in list_scan:
-                            try:
-                                virus_found = scan(path_file)
-                            except Exception as ex:
-                                write_log(log, ex)
+                try:
+                    if config.remove_encryption:
+                        # decrypted ZIP container is written next to input so it can atomically replace it
+                        with NamedTemporaryFile(dir=Path(input).parent, suffix=".tmp", delete=False) as f:
+                            path_output = Path(f.name)
 
-                                return ReturnCode.DETECTED
+                        output = TupleOutput(zf=AESZipFile(path_output, "w", compression=ZIP_DEFLATED if compression is None else compression, compresslevel=compression_level), compression=compression, compression_level=compression_level)
+                    else:
+                        output = None
 
-                            if virus_found is not None:
-                                break
+                    try:
+                        virus_found = extract_members(zf, path_tmpdir, list_scan, output, limits, { "size": 0, "members": 0 })
+                    finally:
+                        if output is not None:
+                            output.zf.close()
+                except ExceptionWrongPassword:
+                    # wrong password
+                    if path_output is not None:
+                        path_output.unlink(missing_ok=True)
 
-                        if virus_found is not None:
-                            write_log(log, f"Virus '{virus_found}'")
+                    continue
+                except Exception as ex:
+                    if path_output is not None:
+                        path_output.unlink(missing_ok=True)
 
-                            return ReturnCode.DETECTED
+                    write_log(log, ex)
 
-                        if config.remove_encryption:
-                            zf_decrypted.writestr(file_name, data)
+                    return ReturnCode.DETECTED
 
-                    break
-                except RuntimeError:
-                    pass
+                record_hit(dict_hits, password)
+
+                break
             else:
                 write_log(log, "Decryption failed")
 
                 return ReturnCode.DETECTED
 
+    if virus_found is not None:
+        if path_output is not None:
+            path_output.unlink(missing_ok=True)
+
+        write_log(log, f"Virus '{virus_found}'")
+
+        return ReturnCode.DETECTED
+
     if config.remove_encryption:
-        zf_decrypted.close()
+        try:
+            path_output.chmod(Path(input).stat().st_mode & 0o777)
+
+            path_output.replace(input)
+        except Exception:
+            path_output.unlink(missing_ok=True)
+
+            write_log(log, f"Cannot replace '{input}'")
 
-        with open(input, "wb") as f:
-            f.write(buffer.getvalue())
+            return ReturnCode.DETECTED
 
         return ReturnCode.MODIFIED
 
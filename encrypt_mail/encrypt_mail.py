@@ -1,24 +1,131 @@
-# encrypt_mail.py V6.2.0
+# encrypt_mail.py V6.3.1
 #
 # Copyright (c) 2020-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
-from re import search, escape, sub, IGNORECASE
+from re import compile, search, escape, sub, IGNORECASE, MULTILINE
 from random import choice
 from string import ascii_letters, digits, punctuation
+from shutil import copyfileobj
+from functools import partial
+from base64 import b64encode, encodebytes
 from email import message, policy
 from email.utils import parseaddr, getaddresses
-from smtplib import SMTP
+from smtplib import SMTP, SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError
+from pyzipper import ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
-CONFIG_PARAMETERS = ( "keyword_encryption", "password_length", "password_punctuation" )
+CONFIG_PARAMETERS = ( "keyword_encryption", "password_length", "password_punctuation", "compression" )
 
 TEMPLATE_RECIPIENT = "You have received an encrypted email from {} attached to this email.\n\nThe password will be provided to you by the sender shortly.\n\nHave a nice day."
 TEMPLATE_SENDER = "The email has been encrypted with the password {} and sent.\n\nPlease provide the recipients with the password.\n\nHave a nice day."
 
 PORT_SMTP=10026
 
+DICT_COMPRESSION = { "stored": ZIP_STORED, "deflate": ZIP_DEFLATED, "bzip2": ZIP_BZIP2, "lzma": ZIP_LZMA }
+
+SIZE_CHUNK = 1048576 # in bytes
+
+SIZE_BASE64_CHUNK = 57 * 16384 # in bytes (multiple of 57 bytes encoded per base64 line)
+
+SET_HEADER_END = { b"\n", b"\r\n" }
+
+# stands in for encrypted ZIP archive when generating MIME structure (length multiple of 3 for base64 without padding)
+PLACEHOLDER_ARCHIVE = b"encrypted ZIP archive placeholder"
+
+PATTERN_LEADING_PERIOD = compile(rb"^\.", MULTILINE)
+
+def copy_email(path_email, f_target, keyword_escaped):
+    """
+    Copy email in chunks removing encryption keyword from subject header (only header block is searched).
+
+    :type path_email: str
+    :type f_target: file
+    :type keyword_escaped: str
+    """
+    pattern_subject = compile(fr"^Subject: *{keyword_escaped} *".encode(), IGNORECASE)
+
+    keyword_removed = False
+
+    with open(path_email, "rb") as f_source:
+        for line in f_source:
+            if not keyword_removed:
+                (line, count) = pattern_subject.subn(b"Subject: ", line, count=1)
+
+                keyword_removed = count > 0
+
+            f_target.write(line)
+
+            if line in SET_HEADER_END:
+                break
+
+        copyfileobj(f_source, f_target, SIZE_CHUNK)
+
+def iter_message(email, f_archive):
+    """
+    Generate SMTP data of email in chunks with encrypted ZIP archive streamed from file and base64 encoded in place of placeholder attachment.
+
+    :type email: EmailMessage
+    :type f_archive: file
+    :rtype: generator
+    """
+    (prefix, suffix) = email.as_bytes().split(b64encode(PLACEHOLDER_ARCHIVE) + b"\r\n")
+
+    # transparency for lines starting with a period (base64 lines never do)
+    yield PATTERN_LEADING_PERIOD.sub(b"..", prefix)
+
+    for chunk in iter(partial(f_archive.read, SIZE_BASE64_CHUNK), b""):
+        yield encodebytes(chunk).replace(b"\n", b"\r\n")
+
+    yield PATTERN_LEADING_PERIOD.sub(b"..", suffix)
+
+def send_streamed(smtp, address_from, set_to, iter_data):
+    """
+    Send email data in chunks without holding whole email in memory.
+
+    :type smtp: SMTP
+    :type address_from: str
+    :type set_to: set
+    :type iter_data: generator
+    """
+    smtp.ehlo_or_helo_if_needed()
+
+    (code, response) = smtp.mail(address_from)
+
+    if code != 250:
+        raise SMTPSenderRefused(code, response, address_from)
+
+    dict_refused = dict()
+
+    for address in set_to:
+        (code, response) = smtp.rcpt(address)
+
+        if code not in { 250, 251 }:
+            dict_refused[address] = ( code, response )
+
+    if len(dict_refused) == len(set_to):
+        smtp.rset()
+
+        raise SMTPRecipientsRefused(dict_refused)
+
+    smtp.putcmd("data")
+
+    (code, response) = smtp.getreply()
+
+    if code != 354:
+        raise SMTPDataError(code, response)
+
+    for data in iter_data:
+        smtp.send(data)
+
+    smtp.send(b".\r\n")
+
+    (code, response) = smtp.getreply()
+
+    if code != 250:
+        raise SMTPDataError(code, response)
+
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
     Zip-encrypt email if trigger keyword present in subject header and send it to recipients and generated password to sender.
@@ -91,8 +198,11 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
         return ReturnCode.ERROR
 
-    # remove encryption keyword from subject header
-    email = sub(fr"(\n|^)Subject: *{keyword_escaped} *", r"\1Subject: ", email.as_string(), count=1, flags=IGNORECASE)
+    if config.compression not in DICT_COMPRESSION:
+        write_log(log, f"Unknown compression method '{config.compression}'")
+
+        return ReturnCode.ERROR
+
     header_subject = sub(fr"^{keyword_escaped} *", "", header_subject, flags=IGNORECASE)
 
     password_characters = ascii_letters + digits
@@ -103,46 +213,63 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
     password = "".join(choice(password_characters) for _ in range(config.password_length))
 
     try:
-        zip_archive = zip_encrypt({ ("email.eml", email) }, password)
+        f_archive = zip_encrypt({ ( "email.eml", partial(copy_email, input, keyword_escaped=keyword_escaped) ) }, password, DICT_COMPRESSION[config.compression])
     except Exception:
         write_log(log, "Error zip-encrypting email")
 
         return ReturnCode.ERROR
 
-    # send email with encrypted original mail attached to recipients
-    email_message = message.EmailMessage(policy=policy.SMTP)
+    # email with encrypted original mail attached to recipients
+    email_recipient = message.EmailMessage(policy=policy.SMTP)
 
-    email_message["Subject"] = header_subject
-    email_message["From"] = address_sender
-    email_message["To"] = ", ".join(address_recipient["To"])
+    email_recipient["Subject"] = header_subject
+    email_recipient["From"] = address_sender
+    email_recipient["To"] = ", ".join(address_recipient["To"])
 
     if "Cc" in address_recipient:
-        email_message["Cc"] = ", ".join(address_recipient["Cc"])
+        email_recipient["Cc"] = ", ".join(address_recipient["Cc"])
 
-    email_message.set_content(TEMPLATE_RECIPIENT.format(address_sender))
-    email_message.add_attachment(zip_archive, maintype="application", subtype="zip", filename="email.zip")
+    email_recipient.set_content(TEMPLATE_RECIPIENT.format(address_sender))
 
-    try:
-        with SMTP("localhost", port=PORT_SMTP) as s:
-            s.send_message(email_message)
-    except Exception:
-        write_log(log, "Cannot send recipient email")
+    # archive is streamed into attachment when sending, so memory usage does not depend on email size
+    email_recipient.add_attachment(PLACEHOLDER_ARCHIVE, maintype="application", subtype="zip", filename="email.zip")
 
-        return ReturnCode.ERROR
+    # email with password to sender
+    email_sender = message.EmailMessage(policy=policy.SMTP)
 
-    # send email with password to sender
-    email_message = message.EmailMessage(policy=policy.SMTP)
+    email_sender["Subject"] = f"Re: {header_subject}"
+    email_sender["From"] = address_sender
+    email_sender["To"] = address_sender
 
-    email_message["Subject"] = f"Re: {header_subject}"
-    email_message["From"] = address_sender
-    email_message["To"] = address_sender
-
-    email_message.set_content(TEMPLATE_SENDER.format(password))
+    email_sender.set_content(TEMPLATE_SENDER.format(password))
 
+    # both emails are sent in a single SMTP session
     try:
-        with SMTP("localhost", port=PORT_SMTP) as s:
-            s.send_message(email_message)
+        smtp = SMTP("localhost", port=PORT_SMTP)
     except Exception:
-        write_log(log, "Cannot send sender email")
+        f_archive.close()
+
+        write_log(log, "Cannot connect to SMTP server")
+
+        return ReturnCode.ERROR
+
+    try:
+        try:
+            with f_archive:
+                send_streamed(smtp, address_sender, set.union(*address_recipient.values()), iter_message(email_recipient, f_archive))
+        except Exception:
+            write_log(log, "Cannot send recipient email")
+
+            return ReturnCode.ERROR
+
+        try:
+            smtp.send_message(email_sender)
+        except Exception:
+            write_log(log, "Cannot send sender email")
+    finally:
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
 
     return ReturnCode.DETECTED
@@ -1,19 +1,15 @@
-# remove_tag.py V7.1.1
+# remove_tag.py V7.3.1
 #
 # Copyright (c) 2021-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
-from sys import setrecursionlimit
 from re import compile, search, escape, sub
 from email.utils import getaddresses
-from bs4 import BeautifulSoup
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
 CONFIG_PARAMETERS = ( "address_tag", "clean_text", "clean_html", "subject_tag", "text_tag", "html_id", "calendar_tag" )
 
-RECURSION_LIMIT = 5000
-
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
     Remove tags in address and subject headers, text and HTML bodies and calendar objects.
@@ -36,8 +32,6 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
         return ReturnCode.DETECTED
 
-    setrecursionlimit(RECURSION_LIMIT)
-
     email_modified = False
 
     if config.address_tag:
@@ -88,29 +82,45 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
             email_modified = True
 
+    dict_part = { TYPE_TEXT: list(), TYPE_HTML: list(), TYPE_CALENDAR: list() }
+
+    list_subtype = list()
+
     if (config.text_tag or (config.address_tag and config.clean_text)):
-        # remove text body tag and address tag from text body
+        list_subtype.append(TYPE_TEXT)
+
+    if (config.html_id or (config.address_tag and config.clean_html)):
+        list_subtype.append(TYPE_HTML)
+
+    if config.calendar_tag:
+        list_subtype.append(TYPE_CALENDAR)
+
+    if list_subtype:
+        # extract all bodies in single walk
 
         try:
-            part = extract_part(email, TYPE_TEXT)
+            for part in iter_parts(email, list_subtype, nested=True):
+                dict_part[part[0].get_content_subtype()].append(part)
         except Exception as ex:
             write_log(log, ex)
 
             return ReturnCode.DETECTED
 
-        if part is not None:
-            (part, charset, content) = part
+    if dict_part[TYPE_TEXT]:
+        # remove text body tag and address tag from text bodies
 
-            body_modified = False
+        if config.text_tag:
+            split_tag = annotation(config.text_tag).text.split("\n")
 
-            if config.text_tag:
-                split_tag = annotation(config.text_tag).text.split("\n")
+            while not split_tag[-1]:
+                del split_tag[-1]
 
-                while not split_tag[-1]:
-                    del split_tag[-1]
+            pattern_tag = compile("\\n".join([ r"(>+ )*" + escape(item) for item in split_tag ]) + r"\n")
 
-                pattern_tag = compile("\\n".join([ r"(>+ )*" + escape(item) for item in split_tag ]) + r"\n")
+        for (part, charset, content) in dict_part[TYPE_TEXT]:
+            body_modified = False
 
+            if config.text_tag:
                 match = search(pattern_tag, content)
 
                 if match is not None:
@@ -131,37 +141,21 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
                 email_modified = True
 
-    if (config.html_id or (config.address_tag and config.clean_html)):
-        # remove HTML body tag and address tag from HTML body
-
-        try:
-            part = extract_part(email, TYPE_HTML)
-        except Exception as ex:
-            write_log(log, ex)
-
-            return ReturnCode.DETECTED
-
-        if part is not None:
-            (part, charset, content) = part
+    if dict_part[TYPE_HTML]:
+        # remove HTML body tag and address tag from HTML bodies
 
+        for (part, charset, content) in dict_part[TYPE_HTML]:
             body_modified = False
 
-            soup = BeautifulSoup(content, features="html5lib")
+            if config.html_id:
+                list_token = list(tokenize_html(content))
 
-            list_tag = soup.find_all("div", id=compile(fr".*{escape(config.html_id)}.*"))
+                list_edit = [ edit_element(list_token, index) for (index, token) in enumerate(list_token) if token.type == HTML_START and token.name == "div" and "id" in token.attributes and config.html_id in token.attributes["id"].value ]
 
-            if list_tag:
-                for tag in list_tag:
-                    tag.decompose()
+                if list_edit:
+                    content = apply_edits(content, list_edit)
 
-                try:
-                    content = soup.encode(charset).decode(charset)
-                except Exception:
-                    write_log(log, "Error converting soup to string")
-
-                    return ReturnCode.DETECTED
-
-                body_modified = True
+                    body_modified = True
 
             if config.address_tag and config.clean_html and address_tag in content:
                 content = content.replace(address_tag, "")
@@ -176,19 +170,10 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
                 email_modified = True
 
-    if config.calendar_tag:
+    if dict_part[TYPE_CALENDAR]:
         # remove calendar tag
 
-        try:
-            part = extract_part(email, TYPE_CALENDAR)
-        except Exception as ex:
-            write_log(log, ex)
-
-            return ReturnCode.DETECTED
-
-        if part is not None:
-            (part, charset, content) = part
-
+        for (part, charset, content) in dict_part[TYPE_CALENDAR]:
             match = search(r"(^|\n)(ORGANIZER;[\S\s\r\n]*?)(\r?\n\S|$)", content)
 
             if match is not None:
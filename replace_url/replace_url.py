@@ -1,10 +1,9 @@
-# replace_url.py V9.1.0
+# replace_url.py V9.2.0
 #
 # Copyright (c) 2020-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
 from re import compile, search, finditer, IGNORECASE
-from bs4 import BeautifulSoup
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = False
@@ -90,12 +89,9 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
             part_text.set_payload(content_text)
 
         if part_html is not None:
-            soup = BeautifulSoup(content_html, features="html5lib")
+            list_edit = [ edit_attribute(token.attributes["href"], config.url_replacement) for token in tokenize_html(content_html) if token.type == HTML_START and token.name == "a" and "href" in token.attributes ]
 
-            for a in soup.findAll("a", href=True):
-                a["href"] = config.url_replacement
-
-            content_html = str(soup)
+            content_html = apply_edits(content_html, list_edit)
 
             part_html.set_payload(content_html)
 
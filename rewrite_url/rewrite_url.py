@@ -1,21 +1,111 @@
-# rewrite_url.py V9.1.1
+# rewrite_url.py V9.4.2
 #
 # Copyright (c) 2022-2024 NetCon Unternehmensberatung GmbH, https://www.netcon-consulting.com
 # Author: Marc Dierksen (m.dierksen@netcon-consulting.com)
 
 from re import compile, search, finditer, sub, IGNORECASE
+from collections import namedtuple
 from urllib.request import urlopen, Request
 from urllib.parse import quote
 from socket import timeout
-from bs4 import BeautifulSoup
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, Future
 
 ADDITIONAL_ARGUMENTS = ( )
 OPTIONAL_ARGUMENTS = True
-CONFIG_PARAMETERS = ( "exception_list", "redirect_list", "timeout", "check_redirect", "url_blacklist", "url_whitelist", "substitution_list", "token_list", "annotation_text", "annotation_html" )
+CONFIG_PARAMETERS = ( "exception_list", "redirect_list", "timeout", "check_redirect", "url_blacklist", "url_whitelist", "substitution_list", "token_list", "annotation_text", "annotation_html", "rewrite_attachment" )
+
+MAX_WORKERS = 4
 
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/98.0.4758.66 Safari/537.36"
 
 PATTERN_STRIP = compile(r"^https?://(\S+)$", IGNORECASE)
+PATTERN_MAILTO = compile(r"^mailto:", IGNORECASE)
+
+# guards URLs being resolved, checked redirect targets and expanded replacements shared by concurrently rewritten bodies
+LOCK_MODIFIED = Lock()
+
+TupleRule = namedtuple("TupleRule", "pattern replace combined")
+TupleSubstitution = namedtuple("TupleSubstitution", "pattern list_rule dict_token dict_replace")
+
+def compile_substitution(list_substitution, dict_token):
+    """
+    Compile URL substitutions (regex and replacement separated by newline) into single alternation for finding first applicable substitution in one scan.
+
+    :type list_substitution: list
+    :type dict_token: dict
+    :rtype: TupleSubstitution
+    """
+    list_rule = list()
+    list_regex = list()
+
+    for substitution in list_substitution:
+        split_substitution = substitution.split("\n")
+
+        regex = split_substitution[0]
+
+        pattern = compile(regex)
+
+        regex = combinable_regex(regex, f"rule_{len(list_rule)}")
+
+        if regex is not None:
+            list_regex.append(regex)
+
+        list_rule.append(TupleRule(pattern=pattern, replace=split_substitution[1], combined=regex is not None))
+
+    if list_regex:
+        try:
+            pattern = compile("|".join(list_regex))
+        except Exception:
+            pattern = None
+
+            list_rule = [ rule._replace(combined=False) for rule in list_rule ]
+    else:
+        pattern = None
+
+    return TupleSubstitution(pattern=pattern, list_rule=list_rule, dict_token=dict_token, dict_replace=dict())
+
+def substitute_url(url, substitution):
+    """
+    Apply first substitution (in list order) modifying URL. Tokens are expanded only in replacements of rules actually applied.
+
+    :type url: str
+    :type substitution: TupleSubstitution
+    :rtype: str
+    """
+    if substitution.pattern is None:
+        index_last = len(substitution.list_rule)
+    else:
+        match = substitution.pattern.search(url)
+
+        # combined rules after first matching rule cannot match earlier in list order
+        index_last = -1 if match is None else int(match.lastgroup[5:])
+
+    for (index, rule) in enumerate(substitution.list_rule):
+        if rule.combined and index > index_last:
+            continue
+
+        with LOCK_MODIFIED:
+            replace = substitution.dict_replace.get(index)
+
+            if replace is None:
+                replace = rule.replace
+
+                for (token, value) in substitution.dict_token.items():
+                    replace = replace.replace(f"${token}", quote(value))
+
+                substitution.dict_replace[index] = replace
+
+        url_replace = sub(rule.pattern, replace, url)
+
+        if url_replace != url:
+            return url_replace
+
+        if index == index_last:
+            # first matching rule does not modify URL, check remaining rules sequentially
+            index_last = len(substitution.list_rule)
+
+    return url
 
 def resolve_redirect(url, request_timeout):
     """
@@ -49,7 +139,7 @@ def check_blacklisted(url, set_whitelist, set_blacklist, name_blacklist):
 
         raise Exception(f"'{url}' listed on '{name_blacklist}'")
 
-def modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, dict_replace):
+def modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution):
     """
     Modify URL.
 
@@ -61,7 +151,7 @@ def modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist,
     :type set_blacklist: set
     :type set_checked: set
     :type name_blacklist: str
-    :type dict_replace: dict
+    :type substitution: TupleSubstitution
     :rtype: str
     """
     if set_redirect is not None:
@@ -70,31 +160,30 @@ def modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist,
                 url_redirect = resolve_redirect(url, request_timeout)
 
                 if url_redirect != url:
-                    if set_checked is not None and url_redirect not in set_checked:
-                        check_blacklisted(url_redirect, set_whitelist, set_blacklist, name_blacklist)
+                    if set_checked is not None:
+                        with LOCK_MODIFIED:
+                            unchecked = url_redirect not in set_checked
 
-                        set_checked.add(url_redirect)
+                            set_checked.add(url_redirect)
+
+                        # a blacklisted redirect aborts rewriting, so it does not matter that other bodies skip the check
+                        if unchecked:
+                            check_blacklisted(url_redirect, set_whitelist, set_blacklist, name_blacklist)
 
                     url = url_redirect
 
                     break
 
-    if dict_replace is not None:
-        for (pattern, replace) in dict_replace.items():
-            url_replace = sub(pattern, replace, url)
-
-            if url_replace != url:
-                url = url_replace
-
-                break
+    if substitution is not None:
+        url = substitute_url(url, substitution)
 
     return url
 
-def modify_text(content, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, dict_replace):
+def modified_url(url, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution):
     """
-    Rewrite URLs in text body.
+    Return modified URL or None if URL is exception or not modified. Each distinct URL is only modified once, bodies rewritten concurrently wait for the result of the first one.
 
-    :type content: str
+    :type url: str
     :type set_exception: set
     :type dict_modified: dict
     :type set_redirect: set
@@ -103,49 +192,47 @@ def modify_text(content, set_exception, dict_modified, set_redirect, request_tim
     :type set_blacklist: set
     :type set_checked: set
     :type name_blacklist: str
-    :type dict_replace: dict
+    :type substitution: TupleSubstitution
     :rtype: str or None
     """
-    dict_url = dict()
+    with LOCK_MODIFIED:
+        future = dict_modified.get(url)
 
-    for url in set(finditer(PATTERN_URL, content)):
-        for pattern in set_exception:
-            if search(pattern, url) is not None:
-                break
-        else:
-            if url in dict_modified:
-                dict_url[url] = dict_modified[url]
-            else:
-                url_modified = modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, dict_replace)
+        pending = future is None
 
-                if url_modified != url:
-                    dict_modified[url] = url_modified
+        if pending:
+            future = Future()
 
-                    dict_url[url] = url_modified
+            dict_modified[url] = future
 
-    if dict_url:
-        index_shift = 0
+    if pending:
+        try:
+            for pattern in set_exception:
+                if search(pattern, url) is not None:
+                    url_modified = url
 
-        for match in finditer(PATTERN_URL, content):
-            url = match.group()
+                    break
+            else:
+                url_modified = modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution)
+        except Exception as ex:
+            future.set_exception(ex)
 
-            if url in dict_url:
-                url_modified = dict_url[url]
+            raise
 
-                content = content[:match.start() + index_shift] + url_modified + content[match.end() + index_shift:]
+        future.set_result(url_modified)
 
-                index_shift += len(url_modified) - len(url)
+    url_modified = future.result()
 
-        return content
+    if url_modified == url:
+        return None
 
-    return None
+    return url_modified
 
-def modify_html(content, charset, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, dict_replace):
+def modify_text(content, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution):
     """
-    Rewrite URLs in HTML body.
+    Rewrite URLs in text body.
 
     :type content: str
-    :type charset: str
     :type set_exception: set
     :type dict_modified: dict
     :type set_redirect: set
@@ -154,108 +241,118 @@ def modify_html(content, charset, set_exception, dict_modified, set_redirect, re
     :type set_blacklist: set
     :type set_checked: set
     :type name_blacklist: str
-    :type dict_replace: dict
+    :type substitution: TupleSubstitution
     :rtype: str or None
     """
-    soup = BeautifulSoup(content, features="html5lib")
+    list_edit = list()
 
-    content_modified = False
+    for match in finditer(PATTERN_URL, content):
+        url_modified = modified_url(match.group(), set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution)
 
-    for url in { a["href"] for a in soup.findAll("a", href=compile(r"^(?!mailto:).+", IGNORECASE)) }:
-        for pattern in set_exception:
-            if search(pattern, url) is not None:
-                break
-        else:
-            modified = False
+        if url_modified is not None:
+            list_edit.append(TupleEdit(start=match.start(), end=match.end(), replacement=url_modified))
 
-            if url in dict_modified:
-                url_modified = dict_modified[url]
-
-                modified = True
-            else:
-                url_modified = modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, dict_replace)
+    if list_edit:
+        return apply_edits(content, list_edit)
 
-                if url_modified != url:
-                    dict_modified[url] = url_modified
+    return None
 
-                    modified = True
+def modify_html(content, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution):
+    """
+    Rewrite URLs in HTML body (link targets, link texts and titles matching the link target and URLs in text).
 
-            if modified:
-                match = search(PATTERN_STRIP, url)
+    :type content: str
+    :type set_exception: set
+    :type dict_modified: dict
+    :type set_redirect: set
+    :type request_timeout: int
+    :type set_whitelist: set
+    :type set_blacklist: set
+    :type set_checked: set
+    :type name_blacklist: str
+    :type substitution: TupleSubstitution
+    :rtype: str or None
+    """
+    list_token = list(tokenize_html(content))
 
-                if match is None:
-                    url_strip = None
-                else:
-                    url_strip = match.group(1)
+    list_edit = list()
 
-                for a in soup.find_all("a", href=url):
-                    a["href"] = url_modified
+    set_replaced = set()
 
-                    if a.text == url:
-                        a.find(text=url).replace_with(url_modified)
-                    elif a.text == url_strip:
-                        a.find(text=url_strip).replace_with(url_modified)
+    for (index, token) in enumerate(list_token):
+        if token.type == HTML_START and token.name == "a" and "href" in token.attributes:
+            url = token.attributes["href"].value
 
-                    if a.has_attr("title"):
-                        title = a["title"]
+            if not url or search(PATTERN_MAILTO, url) is not None:
+                continue
 
-                        if title == url or title == url_strip:
-                            a["title"] = url_modified
+            url_modified = modified_url(url, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution)
 
-                content_modified = True
+            if url_modified is None:
+                continue
 
-    if content_modified:
-        try:
-            content = soup.encode(charset).decode(charset)
-        except Exception:
-            raise Exception("Error converting soup to string")
+            list_edit.append(edit_attribute(token.attributes["href"], url_modified))
 
-    dict_url = dict()
+            match = search(PATTERN_STRIP, url)
 
-    for url in set(finditer(PATTERN_URL, extract_text(content))):
-        for pattern in set_exception:
-            if search(pattern, url) is not None:
-                break
-        else:
-            if url in dict_modified:
-                dict_url[url] = dict_modified[url]
+            if match is None:
+                url_strip = None
             else:
-                url_modified = modify_url(url, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, dict_replace)
+                url_strip = match.group(1)
 
-                if url_modified != url:
-                    dict_modified[url] = url_modified
+            if "title" in token.attributes:
+                title = token.attributes["title"].value
 
-                    dict_url[url] = url_modified
+                if title == url or title == url_strip:
+                    list_edit.append(edit_attribute(token.attributes["title"], url_modified))
 
-    if dict_url:
-        for string in soup.findAll(text=PATTERN_URL):
-            text = string.text
+            for index_text in range(index + 1, html_element_end(list_token, index)):
+                token_text = list_token[index_text]
 
-            index_shift = 0
+                if token_text.type == HTML_TEXT and token_text.name is None:
+                    text = html_unescape(content[token_text.start:token_text.end])
 
-            for match in finditer(PATTERN_URL, text):
-                url = match.group()
+                    if text == url or text == url_strip:
+                        list_edit.append(edit_text(token_text, url_modified))
 
-                if url in dict_url:
-                    url_modified = dict_url[url]
+                        set_replaced.add(index_text)
 
-                    text = text[:match.start() + index_shift] + url_modified + text[match.end() + index_shift:]
+                        break
 
-                    index_shift += len(url_modified) - len(url)
+    for (index, token) in enumerate(list_token):
+        if token.type == HTML_TEXT and token.name is None and index not in set_replaced:
+            for match in finditer(PATTERN_URL, content[token.start:token.end]):
+                url_modified = modified_url(html_unescape(match.group()), set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution)
 
-            string.replace_with(text)
+                if url_modified is not None:
+                    list_edit.append(TupleEdit(start=token.start + match.start(), end=token.start + match.end(), replacement=html_escape(url_modified, quote=False)))
 
-        try:
-            content = soup.encode(charset).decode(charset)
-        except Exception:
-            raise Exception("Error converting soup to string")
+    if list_edit:
+        return apply_edits(content, list_edit)
 
-        content_modified = True
+    return None
 
-    if content_modified:
-        return content
+def modify_body(content_subtype, content, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution):
+    """
+    Rewrite URLs in text or HTML body.
 
-    return None
+    :type content_subtype: str
+    :type content: str
+    :type set_exception: set
+    :type dict_modified: dict
+    :type set_redirect: set
+    :type request_timeout: int
+    :type set_whitelist: set
+    :type set_blacklist: set
+    :type set_checked: set
+    :type name_blacklist: str
+    :type substitution: TupleSubstitution
+    :rtype: str or None
+    """
+    if content_subtype == TYPE_HTML:
+        return modify_html(content, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution)
+
+    return modify_text(content, set_exception, dict_modified, set_redirect, request_timeout, set_whitelist, set_blacklist, set_checked, name_blacklist, substitution)
 
 def run_command(input, log, config, additional, optional, disable_splitting, reformat_header):
     """
@@ -346,24 +443,18 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
     if config.substitution_list:
         try:
-            set_substitution = set(lexical_list(config.substitution_list))
+            # keep list order for substitution precedence
+            list_substitution = list(dict.fromkeys(lexical_list(config.substitution_list)))
         except Exception as ex:
             write_log(log, ex)
 
             return ReturnCode.DETECTED
 
-        if not set_substitution:
+        if not list_substitution:
             write_log(log, "Substitution list is empty")
 
             return ReturnCode.DETECTED
 
-        try:
-            dict_replace = { compile(substitution.split("\n")[0]): substitution.split("\n")[1] for substitution in set_substitution }
-        except Exception:
-            write_log(log, "Invalid substitution list")
-
-            return ReturnCode.DETECTED
-
         if config.token_list:
             try:
                 set_token = set(lexical_list(config.token_list))
@@ -385,44 +476,60 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
                 return ReturnCode.DETECTED
 
             dict_token = { token: optional[token] for token in set_token }
+        else:
+            dict_token = dict()
 
-            for (pattern, replace) in dict_replace.items():
-                modified = False
-
-                for (token, value) in dict_token.items():
-                    token = f"${token}"
+        try:
+            substitution = compile_substitution(list_substitution, dict_token)
+        except Exception:
+            write_log(log, "Invalid substitution list")
 
-                    if token in replace:
-                        replace = replace.replace(token, quote(value))
+            return ReturnCode.DETECTED
+    else:
+        substitution = None
 
-                        modified = True
+    try:
+        list_part = list(iter_parts(email, ( TYPE_TEXT, TYPE_HTML ), nested=config.rewrite_attachment))
 
-                if modified:
-                    dict_replace[pattern] = replace
-    else:
-        dict_replace = None
+        if config.rewrite_attachment:
+            # bodies of attached messages are not annotated (decoding is memoized, so second walk is cheap)
+            set_top = { id(part) for (part, _, _) in iter_parts(email, ( TYPE_TEXT, TYPE_HTML )) }
+        else:
+            set_top = None
+    except Exception as ex:
+        write_log(log, ex)
 
-    email_modified = False
+        return ReturnCode.DETECTED
 
     try:
-        part = extract_part(email, TYPE_TEXT)
+        if set_redirect is not None and len(list_part) > 1:
+            # resolving redirects is I/O bound, so bodies are rewritten concurrently
+            with ThreadPoolExecutor(max_workers=min(len(list_part), MAX_WORKERS)) as executor:
+                list_future = [ executor.submit(modify_body, part.get_content_subtype(), content, set_exception, dict_modified, set_redirect, config.timeout, set_whitelist, set_blacklist, set_checked, config.url_blacklist, substitution) for (part, _, content) in list_part ]
+
+                list_content = [ future.result() for future in list_future ]
+        else:
+            list_content = [ modify_body(part.get_content_subtype(), content, set_exception, dict_modified, set_redirect, config.timeout, set_whitelist, set_blacklist, set_checked, config.url_blacklist, substitution) for (part, _, content) in list_part ]
     except Exception as ex:
         write_log(log, ex)
 
         return ReturnCode.DETECTED
 
-    if part is not None:
-        (part, charset, content) = part
+    email_modified = False
 
-        try:
-            content = modify_text(content, set_exception, dict_modified, set_redirect, config.timeout, set_whitelist, set_blacklist, set_checked, config.url_blacklist, dict_replace)
-        except Exception as ex:
-            write_log(log, ex)
+    set_annotated = set()
 
-            return ReturnCode.DETECTED
+    for ((part, charset, _), content) in zip(list_part, list_content):
+        if content is None:
+            continue
+
+        content_subtype = part.get_content_subtype()
+
+        if content_subtype not in set_annotated and (set_top is None or id(part) in set_top):
+            # annotate first modified top-level body of each type only
+            set_annotated.add(content_subtype)
 
-        if content is not None:
-            if config.annotation_text:
+            if content_subtype == TYPE_TEXT and config.annotation_text:
                 try:
                     annotation_content = annotation(config.annotation_text).text
                 except Exception as ex:
@@ -434,33 +541,7 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
 
                 if charset != CHARSET_UTF8 and not string_ascii(annotation_content):
                     charset = CHARSET_UTF8
-
-            if HEADER_CTE in part:
-                del part[HEADER_CTE]
-
-            part.set_payload(content, charset=charset)
-
-            email_modified = True
-
-    try:
-        part = extract_part(email, TYPE_HTML)
-    except Exception as ex:
-        write_log(log, ex)
-
-        return ReturnCode.DETECTED
-
-    if part is not None:
-        (part, charset, content) = part
-
-        try:
-            content = modify_html(content, charset, set_exception, dict_modified, set_redirect, config.timeout, set_whitelist, set_blacklist, set_checked, config.url_blacklist, dict_replace)
-        except Exception as ex:
-            write_log(log, ex)
-
-            return ReturnCode.DETECTED
-
-        if content is not None:
-            if config.annotation_html:
+            elif content_subtype == TYPE_HTML and config.annotation_html:
                 try:
                     annotation_content = annotation(config.annotation_html).html
                 except Exception as ex:
@@ -473,12 +554,12 @@ def run_command(input, log, config, additional, optional, disable_splitting, ref
                 if charset != CHARSET_UTF8 and not string_ascii(annotation_content):
                     charset = CHARSET_UTF8
 
-            if HEADER_CTE in part:
-                del part[HEADER_CTE]
+        if HEADER_CTE in part:
+            del part[HEADER_CTE]
 
-            part.set_payload(content, charset=charset)
+        part.set_payload(content, charset=charset)
 
-            email_modified = True
+        email_modified = True
 
     if email_modified:
         try: